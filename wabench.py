@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+
+# wapkg benchmark suite
+# Generates a synthetic source (index + package/distro archives), serves it
+# from a local HTTP server and times the library against it.
+
+import os
+import sys
+import gzip
+import json
+import struct
+import hashlib
+import shutil
+import platform
+import argparse
+import tempfile
+
+from time import perf_counter
+from threading import Thread
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+
+from wapkg import remote
+from wapkg import search
+from wapkg.repo import Repository
+from wapkg.unzip import extract_members
+from wapkg.version import get_version
+
+VERSIONS = ['3.6.31.0', '3.7.2.1', '3.8.0.0', '3.8.1.0']
+VERSION_DEFAULT = '3.8.1.0'
+
+
+# Writes a fake WA.exe carrying just enough of VS_FIXEDFILEINFO
+# for calcversioninfo() to recognize the version string
+def make_wa_exe(path, version):
+    a, b, c, d = [int(x) for x in version.split('.')]
+    info = struct.pack('<IIIIIIIII', 0xfeef04bd, 0x00010000, (a << 16) | b, (c << 16) | d,
+                       (a << 16) | b, (c << 16) | d, 0x3f, 0, 0x00040004)
+    with open(path, 'wb') as f:
+        f.write(b'MZ' + bytes(510) + info + bytes(512))
+
+
+# Deterministic filler, half of it compressible
+def _payload(size, seed):
+    head = bytes((seed + i) % 251 for i in range(size // 2))
+    return head + b'W' * (size - len(head))
+
+
+def make_zip(path, meta_name, meta, files, file_size, stored_every=3, extra=None):
+    with ZipFile(path, 'w') as zf:
+        zf.writestr(meta_name, json.dumps(meta))
+        for name, data in (extra or {}).items():
+            zf.writestr(name, data)
+        for i in range(files):
+            d = 'data/' + str(i % 8) + '/'
+            compression = ZIP_STORED if stored_every and i % stored_every == 0 else ZIP_DEFLATED
+            zf.writestr(d + 'file' + str(i) + '.bin', _payload(file_size, i), compress_type=compression)
+
+
+def _sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _pkg_entry(archive, revision, group=None, requirements=None, sha1=None):
+    pkg = {'revision': revision, 'path': archive}
+    if sha1:
+        pkg['sha1'] = sha1
+    if group:
+        pkg['group'] = group
+    if requirements:
+        pkg['requirements'] = requirements
+    return pkg
+
+
+# Returns a description of what has been generated
+def generate_source(root, packages=2000, archives=16, switch_every=5, chain_depth=8,
+                    pkg_files=20, pkg_file_size=4096, dist_files=200, dist_file_size=65536, compressed=True):
+    os.makedirs(os.path.join(root, 'packages'))
+    os.makedirs(os.path.join(root, 'distributions'))
+
+    archive_paths = []
+    sums = {}
+    for i in range(archives):
+        p = 'packages/bench-' + str(i) + '.zip'
+        make_zip(os.path.join(root, p), 'wapkg.json',
+                 {'version': 1, 'name': 'bench-' + str(i), 'revision': 1}, pkg_files, pkg_file_size)
+        archive_paths.append(p)
+        sums[p] = _sha1(os.path.join(root, p))
+
+    index = {'repo': 'wapkg', 'version': remote.VERSION_REQUIRED, 'packages': {}, 'distributions': {}}
+    for i in range(packages):
+        name = 'pkg-' + str(i)
+        a = archive_paths[i % archives]
+        entry = _pkg_entry(a, i % 7 + 1, 'group-' + str(i % 13), sha1=sums[a])
+        entry['description'] = 'Synthetic package ' + str(i) + ', ' + ('map pack', 'scheme', 'sound bank')[i % 3]
+        if switch_every and i % switch_every == 0:
+            vs = VERSIONS[i % len(VERSIONS)]
+            b = archive_paths[(i + 1) % archives]
+            index['packages'][name] = {'switch': {vs + ',' + VERSIONS[0]: entry,
+                                                  '*': _pkg_entry(b, 1, sha1=sums[b])}}
+        else:
+            index['packages'][name] = entry
+
+    for i in range(chain_depth):
+        name = 'chain-' + str(i)
+        p = 'packages/' + name + '.zip'
+        make_zip(os.path.join(root, p), 'wapkg.json', {'version': 1, 'name': name, 'revision': 1},
+                 pkg_files, pkg_file_size)
+        reqs = ['chain-' + str(i + 1)] if i + 1 < chain_depth else None
+        index['packages'][name] = _pkg_entry(p, 1, 'chain', reqs, _sha1(os.path.join(root, p)))
+
+    index['packages']['virtual-chain'] = {'requirements': ['chain-0']}
+
+    exe = os.path.join(root, 'WA.exe')
+    make_wa_exe(exe, VERSION_DEFAULT)
+    with open(exe, 'rb') as f:
+        exe_data = f.read()
+    os.unlink(exe)
+    make_zip(os.path.join(root, 'distributions', 'bench.zip'), 'wadist.json',
+             {'version': 1, 'suggestedName': 'bench'}, dist_files, dist_file_size, extra={'WA.exe': exe_data})
+    index['distributions']['bench'] = {'path': 'distributions/bench.zip',
+                                       'sha1': _sha1(os.path.join(root, 'distributions', 'bench.zip'))}
+
+    with open(os.path.join(root, 'index.json'), 'w') as f:
+        f.write(json.dumps(index))
+    if compressed:
+        with gzip.open(os.path.join(root, 'index.json.gz'), 'wt') as f:
+            f.write(json.dumps(index))
+
+    return {
+        'packages': len(index['packages']),
+        'archives': archives,
+        'chain_depth': chain_depth,
+        'index_bytes': os.path.getsize(os.path.join(root, 'index.json')),
+        'package_archive_bytes': os.path.getsize(os.path.join(root, archive_paths[0])),
+        'dist_archive_bytes': os.path.getsize(os.path.join(root, 'distributions', 'bench.zip'))
+    }
+
+
+# Static file handler with single-range "Range: bytes=a-b" support
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        self._range = None
+        rng = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if not rng or not rng.startswith('bytes=') or ',' in rng or not os.path.isfile(path):
+            return super().send_head()
+
+        size = os.path.getsize(path)
+        start, end = rng[6:].split('-')
+        if start:
+            start, end = int(start), int(end) if end else size - 1
+        else:
+            start, end = max(0, size - int(end)), size - 1
+        end = min(end, size - 1)
+        if start > end:
+            self.send_error(416)
+            return None
+
+        f = open(path, 'rb')
+        f.seek(start)
+        self._range = end - start + 1
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(end) + '/' + str(size))
+        self.send_header('Content-Length', str(self._range))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        if self._range is None:
+            return super().copyfile(source, outputfile)
+        left = self._range
+        while left > 0:
+            buf = source.read(min(65536, left))
+            if not buf:
+                break
+            outputfile.write(buf)
+            left -= len(buf)
+
+
+class SourceServer(object):
+    def __init__(self, root, handler=RangeRequestHandler):
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), partial(handler, directory=root))
+        self.url = 'http://127.0.0.1:' + str(self._httpd.server_address[1]) + '/'
+        self._thread = Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+# Prepares a portable repository in the current working directory
+def make_repository(sources):
+    open('portable', 'w').close()
+    with open('settings.json', 'w') as f:
+        f.write(json.dumps({'sources': sources, 'disable_external_sources_list': True}, indent=4))
+    return Repository()
+
+
+def _stats(samples):
+    s = sorted(samples)
+    return {
+        'runs': len(s),
+        'min': s[0],
+        'median': s[len(s) // 2],
+        'mean': sum(s) / len(s),
+        'max': s[-1]
+    }
+
+
+def _time(fn, before=None, after=None, repeat=5):
+    samples = []
+    for i in range(repeat):
+        if before:
+            before(i)
+        t = perf_counter()
+        fn(i)
+        samples.append(perf_counter() - t)
+        if after:
+            after(i)
+    return _stats(samples)
+
+
+def run(opts):
+    root = tempfile.mkdtemp(prefix='wabench-')
+    cwd = os.getcwd()
+    results = {}
+    try:
+        src = os.path.join(root, 'source')
+        info = generate_source(src, opts.packages, opts.archives, opts.switch_every, opts.chain_depth,
+                               opts.pkg_files, opts.pkg_file_size, opts.dist_files, opts.dist_file_size,
+                               not opts.no_gzip)
+        work = os.path.join(root, 'repo')
+        os.mkdir(work)
+        os.chdir(work)
+
+        with SourceServer(src) as server:
+            repo = make_repository([server.url])
+            index = remote.fetch_index(server.url)
+            pkgs = index['packages']
+
+            results['fetch_index'] = _time(lambda i: remote.fetch_index(server.url), repeat=opts.repeat)
+            results['compact_index'] = _time(lambda i: remote.compact_index(index), repeat=opts.repeat)
+
+            def select_all(i):
+                for name in pkgs:
+                    remote.select_pkg(pkgs[name], VERSION_DEFAULT)
+            results['select_pkg'] = _time(select_all, repeat=opts.repeat)
+
+            compact = remote.compact_index(index).packages
+            info['index_footprint'] = {'raw': remote.footprint(index),
+                                       'compact': remote.footprint(remote.compact_index(index))}
+
+            def select_all_compact(i):
+                for name in compact:
+                    remote.select_pkg(compact[name], VERSION_DEFAULT)
+            results['select_pkg_compact'] = _time(select_all_compact, repeat=opts.repeat)
+
+            def trace_all(i):
+                for name in pkgs:
+                    remote.trace_pkg_deps([pkgs], VERSION_DEFAULT, name)
+            results['trace_pkg_deps'] = _time(trace_all, repeat=opts.repeat)
+
+            results['build_search_index'] = _time(lambda i: search.SearchIndex.build(index), repeat=opts.repeat)
+            si = search.SearchIndex.build(index)
+            results['search'] = _time(lambda i: search.search('sound bank 1', [(server.url, si)]),
+                                      repeat=opts.repeat)
+
+            dist_zip = os.path.join(src, 'distributions', 'bench.zip')
+            extract_dir = os.path.join(root, 'extract')
+
+            def extract(zero_copy):
+                def fn(i):
+                    with ZipFile(dist_zip) as zf:
+                        st = extract_members(zf, zf.namelist(), extract_dir, dist_zip, verified=zero_copy)
+                    info['extract_' + ('zero_copy' if zero_copy else 'classic')] = st.as_dict()
+                return fn
+            for zc in (False, True):
+                results['extract_' + ('zero_copy' if zc else 'classic')] = _time(
+                    extract(zc), after=lambda i: shutil.rmtree(extract_dir), repeat=opts.repeat)
+            results['install_dist_from_file'] = _time(
+                lambda i: repo.install_dist_from_file(dist_zip, 'bench-' + str(i)),
+                after=lambda i: repo.get_distribution('bench-' + str(i)).exterminate(),
+                repeat=opts.repeat)
+
+            repo.install_dist_from_file(dist_zip, 'bench')
+            dist = repo.get_distribution('bench')
+            pkg_zip = os.path.join(src, 'packages', 'bench-0.zip')
+            results['install_package_from_file'] = _time(
+                lambda i: dist.install_package_from_file(pkg_zip),
+                after=lambda i: dist.remove_package('bench-0'),
+                repeat=opts.repeat)
+            results['remove_package'] = _time(
+                lambda i: dist.remove_package('bench-0'),
+                before=lambda i: dist.install_package_from_file(pkg_zip),
+                repeat=opts.repeat)
+
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        'wapkg': get_version(),
+        'python': platform.python_version(),
+        'platform': sys.platform,
+        'params': vars(opts),
+        'source': info,
+        'results': results
+    }
+
+
+def compare(baseline, current):
+    out = []
+    for name in sorted(current['results']):
+        if name not in baseline['results']:
+            continue
+        a = baseline['results'][name]['median']
+        b = current['results'][name]['median']
+        ratio = b / a if a else 0.0
+        out.append(name + ': ' + '%.6f' % a + 's -> ' + '%.6f' % b + 's (x' + '%.2f' % ratio + ')')
+    return '\n'.join(out)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='wapkg benchmark suite')
+    ap.add_argument('--packages', type=int, default=2000, help='number of packages in the synthetic index')
+    ap.add_argument('--archives', type=int, default=16, help='number of distinct package archives')
+    ap.add_argument('--switch-every', type=int, default=5, help='every n-th package gets a switch block')
+    ap.add_argument('--chain-depth', type=int, default=8, help='length of the requirements chain')
+    ap.add_argument('--pkg-files', type=int, default=20, help='files per package archive')
+    ap.add_argument('--pkg-file-size', type=int, default=4096, help='size of each package file, bytes')
+    ap.add_argument('--dist-files', type=int, default=200, help='files in the distro archive')
+    ap.add_argument('--dist-file-size', type=int, default=65536, help='size of each distro file, bytes')
+    ap.add_argument('--no-gzip', action='store_true', help='publish plain index.json only')
+    ap.add_argument('--repeat', type=int, default=5, help='runs per measurement')
+    ap.add_argument('--output', help='write JSON results to this file instead of stdout')
+    ap.add_argument('--compare', help='print medians against a previously saved JSON result')
+    opts = ap.parse_args()
+
+    baseline = None
+    if opts.compare:
+        with open(opts.compare, 'r') as f:
+            baseline = json.loads(f.read())
+    output = opts.output
+    del opts.output, opts.compare
+
+    res = run(opts)
+    data = json.dumps(res, sort_keys=True, indent=4)
+    if output:
+        with open(output, 'w') as f:
+            f.write(data)
+    else:
+        print(data)
+
+    if baseline:
+        print(compare(baseline, res), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Generates an index delta for wapkg sources from two index snapshots.
+# Clients holding the old generation then download just the delta
+# instead of the full index.json.
+
+import os
+import json
+
+from sys import argv, exit
+from wapkg import remote
+
+usage = 'Usage: ' + argv[0] + ''' <old-index.json> <new-index.json> <source-dir>
+
+Writes <source-dir>/''' + remote.DELTA_DIR + '''/<old>-<new>.json and updates head.json there.
+The old snapshot must carry a generation number; if the new one has none,
+it gets old generation + 1, written back into the new snapshot file.'''
+
+
+def make_delta(old, new):
+    delta = {
+        'repo': 'wapkg',
+        'version': new['version'],
+        'from': old['generation'],
+        'to': new['generation']
+    }
+    for section in ('packages', 'distributions'):
+        a = old.get(section, {})
+        b = new.get(section, {})
+        changes = {}
+        for name in b:
+            if name not in a or not a[name] == b[name]:
+                changes[name] = b[name]
+        for name in a:
+            if name not in b:
+                changes[name] = None
+        delta[section] = changes
+    return delta
+
+
+def main():
+    if len(argv) < 4 or argv[1] in ('-h', '--help'):
+        print(usage)
+        exit()
+
+    with open(argv[1], 'r') as f:
+        old = json.loads(f.read())
+    with open(argv[2], 'r') as f:
+        new = json.loads(f.read())
+
+    if not isinstance(old.get('generation'), int):
+        print('The old snapshot has no generation number.')
+        exit(1)
+    if not old['version'] == new['version']:
+        print('Index format versions differ, clients will need a full fetch anyway.')
+        exit(1)
+
+    if 'generation' not in new:
+        new['generation'] = old['generation'] + 1
+        with open(argv[2], 'w') as f:
+            f.write(json.dumps(new, indent=4))
+        print('Assigned generation ' + str(new['generation']) + " to '" + argv[2] + "'")
+    if not new['generation'] > old['generation']:
+        print('The new snapshot must have greater generation number.')
+        exit(1)
+
+    delta_dir = os.path.join(argv[3], remote.DELTA_DIR)
+    if not os.path.exists(delta_dir):
+        os.makedirs(delta_dir)
+
+    delta = make_delta(old, new)
+    name = str(delta['from']) + '-' + str(delta['to']) + '.json'
+    with open(os.path.join(delta_dir, name), 'w') as f:
+        f.write(json.dumps(delta))
+
+    head_path = os.path.join(delta_dir, 'head.json')
+    head = {'deltas': []}
+    if os.path.exists(head_path):
+        with open(head_path, 'r') as f:
+            head = json.loads(f.read())
+    step = [delta['from'], delta['to']]
+    if step not in head['deltas']:
+        head['deltas'].append(step)
+    head['generation'] = max(new['generation'], head.get('generation', 0))
+    with open(head_path, 'w') as f:
+        f.write(json.dumps(head, indent=4))
+
+    changed = len(delta['packages']) + len(delta['distributions'])
+    print('Written ' + name + ' (' + str(changed) + ' entries changed)')
+
+
+if __name__ == '__main__':
+    main()
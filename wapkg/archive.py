@@ -0,0 +1,132 @@
+import os
+import json
+import zlib
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+
+from .unzip import extract_members, _target_path
+
+# Cold storage of distributions: a zip archive with the tree (.wadist included),
+# members compressed only when it pays off. Files sharing content with other
+# distributions (hardlinks, see clone.py) are not stored: another hardlink is
+# kept next to the archive instead, costing no space, and linked back on restore.
+
+MANIFEST = 'wapkg-archive.json'
+
+# Compression of a sample has to save more than this for a member to be deflated
+MIN_SAVING = 0.1
+SAMPLE_SIZE = 65536
+
+
+# Stored for data that does not compress (sounds, images, archives), deflated otherwise.
+# Storing such data saves the CPU time of deflating and inflating it for nothing;
+# restores still check CRC of every member (archives are not sha1-verified).
+def _compress_type(path):
+    with open(path, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+    if len(sample) < 512:
+        return ZIP_DEFLATED
+    if len(zlib.compress(sample, 1)) > len(sample) * (1 - MIN_SAVING):
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+
+def _arcname(rel):
+    return rel.replace(os.sep, '/')
+
+
+# Packs directory tree into archive_path, hardlinked files go into links_dir.
+# skip: relative paths of directories to leave out.
+# Returns counters: files, stored, deflated, linked, bytes (original size).
+def pack_tree(src, archive_path, links_dir, skip=()):
+    stats = {'files': 0, 'stored': 0, 'deflated': 0, 'linked': 0, 'bytes': 0}
+    manifest = {'version': 1, 'linked': [], 'symlinks': {}}
+
+    with ZipFile(archive_path, 'w') as zf:
+        for root, dirs, files in os.walk(src):
+            rel = os.path.relpath(root, src)
+            if rel == '.':
+                rel = ''
+            dirs[:] = [d for d in dirs if os.path.join(rel, d) not in skip]
+            for d in [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+                manifest['symlinks'][_arcname(os.path.join(rel, d))] = os.readlink(os.path.join(root, d))
+            dirs[:] = [d for d in dirs if not os.path.islink(os.path.join(root, d))]
+            if rel and not dirs and not files:
+                zf.writestr(_arcname(rel) + '/', b'')  # keeping empty directories
+
+            for f in files:
+                p = os.path.join(root, f)
+                r = os.path.join(rel, f)
+                if os.path.islink(p):
+                    manifest['symlinks'][_arcname(r)] = os.readlink(p)
+                    continue
+
+                st = os.stat(p)
+                stats['files'] += 1
+                stats['bytes'] += st.st_size
+                if st.st_nlink > 1:
+                    t = os.path.join(links_dir, r)
+                    os.makedirs(os.path.dirname(t), exist_ok=True)
+                    os.link(p, t)
+                    manifest['linked'].append(_arcname(r))
+                    stats['linked'] += 1
+                    continue
+
+                ct = _compress_type(p)
+                zf.write(p, _arcname(r), compress_type=ct)
+                stats['stored' if ct == ZIP_STORED else 'deflated'] += 1
+
+        zf.writestr(MANIFEST, json.dumps(manifest))
+
+    return stats
+
+
+# Restores tree packed by pack_tree() into target (which must not exist),
+# extracting with several threads, each reading the archive on its own.
+# Returns counters: files, linked.
+def unpack_tree(archive_path, links_dir, target, jobs=4):
+    with ZipFile(archive_path) as zf:
+        manifest = json.loads(zf.read(MANIFEST).decode('utf-8'))
+        infos = [i for i in zf.infolist() if not i.filename == MANIFEST]
+
+    # Spreading members over workers by size, biggest first
+    parts = [[] for x in range(max(1, jobs))]
+    loads = [0] * len(parts)
+    for info in sorted(infos, key=lambda x: -x.file_size):
+        i = loads.index(min(loads))
+        parts[i].append(info.filename)
+        loads[i] += info.file_size + 1
+
+    os.makedirs(target)
+    # Directories are made up front, workers sharing a parent would race creating it
+    for info in infos:
+        path = _target_path(info.filename, target)
+        os.makedirs(path if info.is_dir() else os.path.dirname(path), exist_ok=True)
+
+    def extract(names):
+        with ZipFile(archive_path) as zf:
+            extract_members(zf, names, target, archive_path)
+
+    with ThreadPoolExecutor(len(parts)) as pool:
+        list(pool.map(extract, [p for p in parts if p]))
+
+    for name in manifest['linked']:
+        t = os.path.join(target, *name.split('/'))
+        os.makedirs(os.path.dirname(t), exist_ok=True)
+        os.link(os.path.join(links_dir, *name.split('/')), t)
+    for name, link in manifest['symlinks'].items():
+        t = os.path.join(target, *name.split('/'))
+        os.makedirs(os.path.dirname(t), exist_ok=True)
+        os.symlink(link, t)
+
+    files = sum(1 for i in infos if not i.is_dir())
+    return {'files': files + len(manifest['linked']), 'linked': len(manifest['linked'])}
+
+
+def remove_archive(archive_path, links_dir):
+    if os.path.exists(links_dir):
+        shutil.rmtree(links_dir)
+    if os.path.exists(archive_path):
+        os.unlink(archive_path)
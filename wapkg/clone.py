@@ -0,0 +1,96 @@
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409  # Linux ioctl, shares extents on btrfs, xfs, etc.
+
+# Directories the game itself writes files in (teams, schemes, options, replays, logs).
+# Their files are never hardlinked: the game would change them in every linked distro.
+GAME_WRITABLE = ['User']
+
+
+def _reflink(src, dst):
+    if not fcntl:
+        return False
+    with open(src, 'rb') as s:
+        with open(dst, 'wb') as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            except OSError:
+                failed = True
+            else:
+                failed = False
+    if failed:
+        os.unlink(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+# Returns the way the file has been cloned: 'reflinked', 'hardlinked' or 'copied'.
+# Reflinks are independent copies sharing storage until written, hardlinks are the
+# same file: writes show up in both, which is why they are opt-in.
+def clone_file(src, dst, hardlinks=False):
+    if _reflink(src, dst):
+        return 'reflinked'
+    if hardlinks:
+        try:
+            os.link(src, dst)
+            return 'hardlinked'
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return 'copied'
+
+
+# Clones directory tree, sharing file content where possible. Files
+# under .wadist are always copied, as wapkg writes them in place, and so
+# are GAME_WRITABLE ones unless they can be reflinked.
+# skip: relative paths of directories to leave out.
+# Returns counters of clone_file() outcomes.
+def clone_tree(src, dst, hardlinks=False, skip=()):
+    stats = {'reflinked': 0, 'hardlinked': 0, 'copied': 0}
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        if rel == '.':
+            rel = ''
+        dirs[:] = [d for d in dirs if os.path.join(rel, d) not in skip]
+
+        target = os.path.join(dst, rel)
+        os.makedirs(target, exist_ok=True)
+        top = rel.split(os.sep)[0]
+        private = top == '.wadist'
+        writable = top.lower() in [x.lower() for x in GAME_WRITABLE]  # case-insensitive on Windows
+        for d in dirs:
+            p = os.path.join(root, d)
+            if os.path.islink(p):
+                os.symlink(os.readlink(p), os.path.join(target, d))
+        dirs[:] = [d for d in dirs if not os.path.islink(os.path.join(root, d))]
+
+        for f in files:
+            p = os.path.join(root, f)
+            t = os.path.join(target, f)
+            if os.path.islink(p):
+                os.symlink(os.readlink(p), t)
+            elif private:
+                shutil.copy2(p, t)
+                stats['copied'] += 1
+            else:
+                stats[clone_file(p, t, hardlinks and not writable)] += 1
+
+    return stats
+
+
+# Makes path an independent file before it gets overwritten, so that
+# a hardlinked clone does not modify the distribution it was cloned from
+def break_link(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return
+    if st.st_nlink > 1 and os.path.isfile(path):
+        os.unlink(path)
@@ -5,18 +5,25 @@ import shutil
 import sqlite3
 
 from urllib.error import URLError
-from urllib.parse import urljoin
 from uuid import uuid4
 from zipfile import ZipFile
 
 from ._3rdparty.fileversion import calcversioninfo
+from . import locks
 from . import remote
+from . import schema
+from . import trace
+from .unzip import extract_members
 from .download import Downloader
 
 
 class Distribution(object):
-    def __init__(self, path):
+    # mirror_stats: optional mirrors.MirrorStats used to pick download mirrors
+    # scheduler: optional download.DownloadScheduler to take transfer slots from
+    def __init__(self, path, mirror_stats=None, scheduler=None):
         self.wd = path
+        self.mirror_stats = mirror_stats
+        self.scheduler = scheduler
         self.repo = os.path.join(path, '.wadist')
         self.pkgdb = os.path.join(self.repo, 'packages.db')
 
@@ -26,19 +33,37 @@ class Distribution(object):
         if not os.path.exists(self.repo):
             raise RuntimeError('The path specified does not exist (not a distro?)')
 
-        with open(os.path.join(self.repo, 'version'), 'r') as ver:
-            if not int(ver.read()) == 1:
-                raise RuntimeError('Distro version mismatch')
+        with self.lock():  # waits for a distro being installed to be complete
+            if not os.path.exists(os.path.join(self.repo, 'version')):
+                # Removed (archived, exterminated) while waiting for the lock
+                raise RuntimeError('The path specified does not exist (not a distro?)')
+            with open(os.path.join(self.repo, 'version'), 'r') as ver:
+                if int(ver.read()) > schema.DISTRO_VERSION:
+                    raise RuntimeError('Distro version mismatch (made by a newer wapkg version?)')
+
+            with sqlite3.connect(self.pkgdb) as conn:
+                schema.migrate(conn)
 
         self.clean_cache()
 
+    # Shared lock for reading, exclusive for changing the distro (see locks.FileLock)
+    def lock(self, exclusive=False, blocking=True):
+        return locks.FileLock(os.path.join(self.repo, 'lock'), exclusive, blocking)
+
+    # Shared while files in .wadist/cache are in use, exclusive for cleaning it up.
+    # Separate from lock(), so that installing a downloaded file does not need an upgrade
+    # (which flock does not do atomically, letting a cleanup in between).
+    def cache_lock(self, exclusive=False, blocking=True):
+        return locks.FileLock(os.path.join(self.repo, 'cache.lock'), exclusive, blocking)
+
     def get_name(self):
         return self.wd.split(os.sep)[-1]
 
     # Returns None when no data found
     def get_version_string(self):
         if not self._version_string_cached:
-            self._version_string = calcversioninfo(os.path.join(self.wd, 'WA.exe'))
+            with self.lock():
+                self._version_string = calcversioninfo(os.path.join(self.wd, 'WA.exe'))
             self._version_string_cached = True
 
         return self._version_string
@@ -46,7 +71,7 @@ class Distribution(object):
     # Returns list of names
     def list_packages(self):
         list = []
-        with sqlite3.connect(self.pkgdb) as conn:
+        with self.lock(), sqlite3.connect(self.pkgdb) as conn:
             c = conn.cursor()
             for pkg in c.execute('SELECT name FROM packages ORDER BY name'):
                 list.append(pkg[0])
@@ -55,7 +80,7 @@ class Distribution(object):
 
     # Returns None in case of fail, integer otherwise.
     def get_package_revision(self, name):
-        with sqlite3.connect(self.pkgdb) as conn:
+        with self.lock(), sqlite3.connect(self.pkgdb) as conn:
             c = conn.cursor()
             c.execute('SELECT revision FROM packages WHERE name=?', (name,))
             row = c.fetchone()
@@ -63,9 +88,35 @@ class Distribution(object):
                 return None
             return row[0]
 
+    # Returns list of (path, package) for the path given and everything under it,
+    # or starting with it when it is just a name prefix
+    def find_owners(self, path):
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.wd)
+        path = path.replace(os.sep, '/')
+        while path.startswith('./'):
+            path = path[2:]
+
+        with self.lock(), sqlite3.connect(self.pkgdb) as conn:
+            c = conn.cursor()
+            if not path:
+                return c.execute('SELECT path, package FROM paths ORDER BY path').fetchall()
+            # Range over the primary key index: prefix <= path < prefix with its last character incremented
+            upper = path[:-1] + chr(ord(path[-1]) + 1)
+            return c.execute('SELECT path, package FROM paths WHERE path>=? AND path<? ORDER BY path',
+                             (path, upper)).fetchall()
+
     # This and following package-related methods return tuple (succeeded, msg).
     # Exceptions may be thrown.
-    def install_package_from_file(self, path):
+    # conflicts: optional list to append (path, package) of other packages' files being overwritten to
+    # verified: file was checked against sha1 from the index (see unzip.extract_members())
+    def install_package_from_file(self, path, conflicts=None, verified=False):
+        with trace.span('install_package_from_file', path=path), self.lock(True):
+            return self._install_package_from_file(path, conflicts, verified)
+
+    def _install_package_from_file(self, path, conflicts, verified):
+        # Packages are free to replace WA.exe
+        self._version_string_cached = False
         with ZipFile(path) as zf:
             wapkg = json.loads(zf.read('wapkg.json').decode('utf-8'))
             if not wapkg['version'] == 1:
@@ -77,36 +128,56 @@ class Distribution(object):
                 else:
                     return False, 'Package is already installed and updating is not required'
 
+            names = []
+            for n in zf.namelist():
+                if n == 'wapkg.json' or n.startswith('.wadist'):
+                    continue
+                names.append(n)
+
             with sqlite3.connect(self.pkgdb) as conn:
                 c = conn.cursor()
-                c.execute('INSERT INTO packages (name, revision) VALUES (?, ?)', (wapkg['name'], wapkg['revision']))
-
-                for n in zf.namelist():
-                    if n == 'wapkg.json' or n.startswith('.wadist'):
-                        continue
-                    is_dir = 0
-                    if n[-1] == '/':
-                        is_dir = 1
-
-                    exist = False
-                    for f in c.execute('SELECT path FROM paths WHERE path=? LIMIT 1', (n,)):
-                        exist = True
-                        break
-                    if not exist:
-                        c.execute('INSERT INTO paths (path, dir, package) VALUES (?, ?, ?)', (n, is_dir, wapkg['name']))
-                    zf.extract(n, self.wd)
-
-                conn.commit()
+                with trace.span('register', files=len(names)) as sp:
+                    c.execute('INSERT INTO packages (name, revision) VALUES (?, ?)',
+                              (wapkg['name'], wapkg['revision']))
+
+                    # Paths owned already are looked up with a single join instead of a query per file
+                    c.execute('CREATE TEMP TABLE incoming(path char(512) not null primary key, dir int(1) not null,'
+                              'size int, crc int)')
+                    c.executemany('INSERT OR IGNORE INTO incoming (path, dir, size, crc) VALUES (?, ?, ?, ?)',
+                                  ((i.filename, int(i.is_dir()), i.file_size, i.CRC) for i in map(zf.getinfo, names)))
+                    owned = c.execute('SELECT paths.path, paths.package FROM incoming '
+                                      'JOIN paths ON paths.path=incoming.path '
+                                      'WHERE incoming.dir=0 AND paths.dir=0 ORDER BY paths.path').fetchall()
+                    c.execute('INSERT OR IGNORE INTO paths (path, dir, package, size, crc) '
+                              'SELECT path, dir, ?, size, crc FROM incoming', (wapkg['name'],))
+                    c.execute('DROP TABLE temp.incoming')
+                    sp.set(conflicts=len(owned))
+                    if conflicts is not None:
+                        conflicts.extend(owned)
+
+                with trace.span('extract') as sp:
+                    sp.set(**extract_members(zf, names, self.wd, path, verified).as_dict())
+
+                with trace.span('commit'):
+                    conn.commit()
 
         return True, 'Success'
 
-    def install_package_by_name(self, name, sources, precached_index=None):
+    # index_cache: optional remote.IndexCache to take indexes from
+    # downloads: optional download.SharedDownloads to take archives from
+    # conflicts: see install_package_from_file()
+    @trace.traced('install_package_by_name')
+    def install_package_by_name(self, name, sources, precached_index=None, index_cache=None, downloads=None,
+                                conflicts=None):
         revision_fail = False
         installed_any_reqs = False
+        if not index_cache:
+            index_cache = remote.IndexCache()
+
         for src in sources:
             index = precached_index
             if not index:
-                index = remote.fetch_index(src)
+                index = index_cache.fetch(src)
                 if not index:
                     continue
 
@@ -119,7 +190,7 @@ class Distribution(object):
 
             if 'requirements' in pkg:
                 for req in pkg['requirements']:
-                    ok, msg = self.install_package_by_name(req, sources, index)
+                    ok, msg = self.install_package_by_name(req, sources, index, index_cache, downloads, conflicts)
                     if not installed_any_reqs:
                         installed_any_reqs = ok
 
@@ -136,23 +207,31 @@ class Distribution(object):
                     continue
 
             if 'path' in pkg or 'uri' in pkg:
-                if 'path' in pkg:
-                    link = urljoin(src, pkg['path'])
-                else:
-                    link = pkg['uri']
+                links = [remote.entry_link(src, pkg)]
+                vs = self.get_version_string()
+                for link in remote.find_mirrors(pkg, sources, index_cache.fetch,
+                                                lambda x: remote.select_pkg(x['packages'].get(name), vs)):
+                    if link not in links:
+                        links.append(link)
 
-                path = os.path.join(self.repo, 'cache', str(uuid4()))
                 hexdigest = None
                 if 'sha1' in pkg:
                     hexdigest = pkg['sha1']
-                try:
-                    Downloader().go(link, path).verify_sha1(hexdigest)
-                except URLError:
-                    continue
+                with self.cache_lock():  # keeps cache cleanups off the file being downloaded
+                    try:
+                        if downloads:
+                            path = downloads.get(links, hexdigest)
+                        else:
+                            path = os.path.join(self.repo, 'cache', str(uuid4()))
+                            downloader = Downloader(scheduler=self.scheduler)
+                            downloader.go_mirrors(links, path, stats=self.mirror_stats).verify_sha1(hexdigest)
+                    except URLError:
+                        continue
 
-                inst = self.install_package_from_file(path)
-                self.clean_cache()
-                return inst
+                    inst = self.install_package_from_file(path, conflicts, bool(hexdigest))
+                    if not downloads:
+                        os.unlink(path)  # files of concurrent installs may be in the cache too
+                    return inst
 
         message = 'No suitable package source found'
         if revision_fail:
@@ -160,52 +239,66 @@ class Distribution(object):
         return revision_fail and installed_any_reqs, message
 
     def remove_package(self, name):
+        with trace.span('remove_package', package=name), self.lock(True):
+            return self._remove_package(name)
+
+    def _remove_package(self, name):
         if name not in self.list_packages():
             return False, 'No such package installed'
 
+        self._version_string_cached = False
+
         with sqlite3.connect(self.pkgdb) as conn:
             c = conn.cursor()
-            for f in c.execute('SELECT path FROM paths WHERE package=? AND dir=0', (name,)):
-                p = os.path.join(self.wd, f[0])
-                if os.path.exists(p):
-                    os.remove(p)
-
-            dirs = []
-            for d in c.execute('SELECT path FROM paths WHERE package=? AND NOT dir=0', (name,)):
-                dirs.append(d[0])
-
-            depth = 1
-            depth_collected = False
-
-            while depth:
-                for d in dirs:
+            with trace.span('remove_files'):
+                for f in c.execute('SELECT path FROM paths WHERE package=? AND dir=0', (name,)):
+                    p = os.path.join(self.wd, f[0])
+                    if os.path.exists(p):
+                        os.remove(p)
+
+            with trace.span('remove_dirs'):
+                dirs = []
+                for d in c.execute('SELECT path FROM paths WHERE package=? AND NOT dir=0', (name,)):
+                    dirs.append(d[0])
+
+                depth = 1
+                depth_collected = False
+
+                while depth:
+                    for d in dirs:
+                        if not depth_collected:
+                            dc = d.count('/')
+                            if dc > depth:
+                                depth = dc
+
+                        p = os.path.join(self.wd, d)
+                        try:
+                            if os.path.exists(p):
+                                os.rmdir(p)
+                        except OSError as e:
+                            if not e.errno == errno.ENOTEMPTY:
+                                raise
+
+                    depth -= 1
                     if not depth_collected:
-                        dc = d.count('/')
-                        if dc > depth:
-                            depth = dc
+                        depth_collected = True
 
-                    p = os.path.join(self.wd, d)
-                    try:
-                        if os.path.exists(p):
-                            os.rmdir(p)
-                    except OSError as e:
-                        if not e.errno == errno.ENOTEMPTY:
-                            raise
-
-                depth -= 1
-                if not depth_collected:
-                    depth_collected = True
-
-            c.execute('DELETE FROM paths WHERE package=?', (name,))
-            c.execute('DELETE FROM packages WHERE name=?', (name,))
-            conn.commit()
+            with trace.span('unregister'):
+                c.execute('DELETE FROM paths WHERE package=?', (name,))
+                c.execute('DELETE FROM packages WHERE name=?', (name,))
+                conn.commit()
 
         return True, 'Success'
 
+    # Skipped while anything else is using the distro
     def clean_cache(self):
-        path = os.path.join(self.repo, 'cache')
-        for x in os.listdir(path):
-            os.unlink(os.path.join(path, x))
+        with self.cache_lock(True, False) as lock:
+            if not lock.acquired:
+                return
+            path = os.path.join(self.repo, 'cache')
+            for x in os.listdir(path):
+                os.unlink(os.path.join(path, x))
 
     def exterminate(self):
-        shutil.rmtree(self.wd)
+        with self.lock(True):
+            shutil.rmtree(self.wd)
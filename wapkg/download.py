@@ -1,56 +1,232 @@
+import os
+import heapq
 import hashlib
+import threading
 
+from itertools import count
 from sys import stdout
-from urllib.request import urlopen
+from time import time, sleep
+from socket import timeout as SocketTimeout
+from urllib.request import urlopen, Request
+from urllib.error import URLError
+from urllib.parse import urlsplit
+from uuid import uuid4
+
+from . import trace
+
+# Seconds without any data before a transfer is considered stalled
+STALL_TIMEOUT = 60
+
+# Download priorities, lower goes first
+PRIORITY_INTERACTIVE = 0  # packages
+PRIORITY_BACKGROUND = 10  # distributions
+
+
+# Shares transfer slots between everything downloading in the process: at most
+# max_active transfers at once, max_per_host of them from the same host, and
+# optionally at most rate_limit bytes per second all together. Waiting transfers
+# are served by priority, then in order of arrival; one waiting for a busy host
+# does not hold back those for other hosts.
+class DownloadScheduler(object):
+    def __init__(self, max_active=4, max_per_host=2, rate_limit=0):
+        self.max_active = max(1, max_active)
+        self.max_per_host = max(1, max_per_host)
+        self.rate_limit = rate_limit
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of [priority, seq, host]
+        self._seq = count()
+        self._active = 0
+        self._hosts = {}
+        self._rate_next = 0.0
+
+    def _eligible(self, host):
+        return self._active < self.max_active and self._hosts.get(host, 0) < self.max_per_host
+
+    # Returns 1-based position among waiting transfers that could start if slots were free
+    def _position(self, entry):
+        return 1 + sum(1 for x in self._waiting if x < entry and self._hosts.get(x[2], 0) < self.max_per_host)
+
+    # Blocks until a transfer from link may start; action gets queue position updates while waiting.
+    # Returns host the slot is taken for, to be given back with release().
+    def acquire(self, link, priority=PRIORITY_INTERACTIVE, action=None):
+        host = urlsplit(link).netloc
+        with self._cond:
+            entry = [priority, next(self._seq), host]
+            heapq.heappush(self._waiting, entry)
+            reported = None
+            with trace.span('download_queue', host=host) as sp:
+                while True:
+                    if self._eligible(host) and not any(x < entry and self._eligible(x[2]) for x in self._waiting):
+                        break
+                    position = self._position(entry)
+                    if action and not position == reported:
+                        action.update_queue(position)
+                        reported = position
+                    self._cond.wait()
+                sp.set(waited=reported is not None)
+
+            self._waiting.remove(entry)
+            heapq.heapify(self._waiting)
+            self._active += 1
+            self._hosts[host] = self._hosts.get(host, 0) + 1
+            if reported is not None and action:
+                action.update_queue(0)
+            self._cond.notify_all()  # positions have changed
+        return host
+
+    def release(self, host):
+        with self._cond:
+            self._active -= 1
+            self._hosts[host] -= 1
+            if not self._hosts[host]:
+                del self._hosts[host]
+            self._cond.notify_all()
+
+    # Sleeps as long as needed to keep all transfers together within rate_limit
+    def throttle(self, nbytes):
+        if not self.rate_limit:
+            return
+        with self._cond:
+            now = time()
+            start = max(self._rate_next, now)
+            self._rate_next = start + nbytes / self.rate_limit
+        if start > now:
+            sleep(start - now)
 
 
 class Downloader(object):
-    def __init__(self, quiet=False):
+    # scheduler: optional DownloadScheduler to take transfer slots from
+    def __init__(self, quiet=False, scheduler=None, priority=PRIORITY_INTERACTIVE):
         self.quiet = quiet
+        self.scheduler = scheduler
+        self.priority = priority
         self._last_path = None
 
     # URLError is thrown in case of errors
     def go(self, link, path, action=None):
-        with urlopen(link) as req:
+        return self.go_mirrors([link], path, action)
+
+    # Downloads a file available at several equivalent links (same content).
+    # With stats (mirrors.MirrorStats) given, links are tried in order of recorded
+    # performance, and a transfer that gets slower than stats.min_throughput
+    # is continued from the next link using a Range request.
+    # URLError is thrown when no link succeeds.
+    def go_mirrors(self, links, path, action=None, stats=None):
+        if stats:
+            links = stats.rank(links)
+
+        with trace.span('download', link=links[0], mirrors=len(links)) as sp:
+            error = None
+            offset = 0
             with open(path, 'wb') as f:
-                if self.quiet:
-                    f.write(req.read())
-                else:
-                    seg = 131072  # 128K
-                    total = 0
-                    dl_size = ''
-                    dl_size_int = -1
-
-                    if link.startswith('http'):
-                        cl = req.info().get('Content-Length')
-                        dl_size_int = int(int(cl) / 1024)
-                        dl_size = '/' + str(dl_size_int)
-
-                    while True:
-                        chunk = req.read(seg)
-                        total += int(len(chunk) / 1024)
-                        msg = '- Downloading ' + link.split('/')[-1] + ', ' + str(total) + dl_size + ' KB'
-                        if action:
-                            action.update_progress(total, dl_size_int)
-
-                        stdout.write('\r' + msg)
-                        f.write(chunk)
-                        if len(chunk) < seg:
-                            break
-
-                    print()  # newline
-                    self._last_path = path
-
-        return self
+                for i, link in enumerate(links):
+                    min_throughput = None
+                    if stats and i < len(links) - 1 and not (self.scheduler and self.scheduler.rate_limit):
+                        min_throughput = stats.min_throughput  # throttled transfers are slow on purpose
+                    slot = None
+                    if self.scheduler:
+                        slot = self.scheduler.acquire(link, self.priority, action)
+                    offset = f.tell()  # bytes a failed transfer wrote before breaking off are kept
+                    try:
+                        offset, done = self._transfer(link, f, offset, action, stats, min_throughput)
+                    except (URLError, SocketTimeout, ConnectionError) as e:
+                        if stats:
+                            stats.record_failure(link)
+                        error = e
+                        continue
+                    finally:
+                        if slot is not None:
+                            self.scheduler.release(slot)
+
+                    if done:
+                        sp.set(bytes=offset, link=link)
+                        self._last_path = path
+                        if stats:
+                            stats.save()
+                        return self
+
+                    sp.set(switched=i + 1)
+
+            if stats:
+                stats.save()
+            if isinstance(error, URLError):
+                raise error
+            raise URLError(error or 'Download is too slow')
+
+    # Returns (bytes written in total, whether the transfer is complete)
+    def _transfer(self, link, f, offset, action, stats, min_throughput):
+        req = Request(link)
+        if offset:
+            req.add_header('Range', 'bytes=' + str(offset) + '-')
+
+        started = time()
+        with urlopen(req, timeout=STALL_TIMEOUT) as resp:
+            latency = time() - started
+            if offset and not getattr(resp, 'status', None) == 206:
+                # No range support, starting over
+                f.seek(0)
+                f.truncate()
+                offset = 0
+
+            dl_size = ''
+            dl_size_int = -1
+            expected = None
+            cl = resp.info().get('Content-Length')
+            if cl:
+                expected = int(cl) + offset
+            if link.startswith('http') and cl:
+                dl_size_int = int(expected / 1024)
+                dl_size = '/' + str(dl_size_int)
+
+            seg = 131072  # 128K
+            received = 0
+            started = time()
+            window_start, window_bytes = started, 0
+            while True:
+                chunk = resp.read(seg)
+                if not chunk:
+                    break
+                f.write(chunk)
+                offset += len(chunk)
+                received += len(chunk)
+                window_bytes += len(chunk)
+                if self.scheduler:
+                    self.scheduler.throttle(len(chunk))
+
+                total = int(offset / 1024)
+                if action:
+                    action.update_progress(total, dl_size_int)
+                if not self.quiet:
+                    stdout.write('\r- Downloading ' + link.split('/')[-1] + ', ' + str(total) + dl_size + ' KB')
+
+                now = time()
+                if min_throughput and now - window_start >= stats.grace:
+                    if window_bytes / (now - window_start) < min_throughput:
+                        stats.record(link, latency, received, now - started)
+                        stats.record_failure(link)
+                        if not self.quiet:
+                            print(' (too slow, switching mirror)')
+                        return offset, False
+                    window_start, window_bytes = now, 0
+
+            if not self.quiet:
+                print()  # newline
+            if expected is not None and offset < expected:
+                raise ConnectionError('Connection closed after ' + str(offset) + ' of ' + str(expected) + ' bytes')
+            if stats:
+                stats.record(link, latency, received, time() - started)
+
+        return offset, True
 
     # Raises RuntimeError when verifying fails
     def _verify(self, hexdigest, algo):
         if not hexdigest or not self._last_path:
             return
 
-        hash = hashlib.new(algo)
-        with open(self._last_path, 'rb') as f:
-            hash.update(f.read())
+        with trace.span('verify', algo=algo):
+            hash = hashlib.new(algo)
+            with open(self._last_path, 'rb') as f:
+                hash.update(f.read())
         if not hash.hexdigest() == hexdigest.lower():
             raise RuntimeError('Checksum does not match')
 
@@ -58,9 +234,53 @@ class Downloader(object):
         self._verify(hexdigest, 'sha1')
 
 
+# Downloads every archive once for several consumers, e.g. when the same
+# package goes into many distributions. Files are identified by sha1 when known.
+class SharedDownloads(object):
+    def __init__(self, directory, stats=None, scheduler=None):
+        self.directory = directory
+        self.stats = stats
+        self.scheduler = scheduler
+        self._paths = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    # Returns path of the downloaded (and verified) file.
+    # Raises URLError or RuntimeError just like Downloader does.
+    def get(self, links, hexdigest=None):
+        key = links[0]
+        if hexdigest:
+            key = hexdigest.lower()
+
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._paths:
+                path = os.path.join(self.directory, str(uuid4()) + '.download')
+                try:
+                    Downloader(True, self.scheduler).go_mirrors(links, path, stats=self.stats).verify_sha1(hexdigest)
+                except Exception:
+                    if os.path.exists(path):
+                        os.unlink(path)
+                    raise
+                self._paths[key] = path
+            return self._paths[key]
+
+    def clean(self):
+        with self._lock:
+            for path in self._paths.values():
+                if os.path.exists(path):
+                    os.unlink(path)
+            self._paths.clear()
+
+
 class DownloadAction(object):
     def __init__(self, token):
         self.token = token
 
     def update_progress(self, current, total):
         pass
+
+    # Position in the download queue (see DownloadScheduler), 0 once the transfer starts
+    def update_queue(self, position):
+        pass
@@ -0,0 +1,60 @@
+from time import time
+
+from .store import JSONStore
+
+# Seconds a source is skipped for after its first failure, doubled with every next one
+BACKOFF_BASE = 60
+BACKOFF_MAX = 6 * 3600
+# Seconds the index file format found on a source is trusted for before probing again
+FORMAT_TTL = 24 * 3600
+
+
+# Availability history of sources (index hosts, external list), persisted in the
+# repository. Sources failing in a row are not contacted again until their backoff
+# window is over, so a dead host costs one timeout per window instead of one per command.
+class SourceHealth(JSONStore):
+    def __init__(self, path, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX):
+        super().__init__(path)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    # Returns record dictionary (last_success, failures, latency, retry_at, index_format, format_checked),
+    # None if never contacted
+    def get(self, url):
+        with self._lock:
+            rec = self._load().get(url)
+            return dict(rec) if rec else None
+
+    # False while the source is in its backoff window
+    def available(self, url):
+        with self._lock:
+            rec = self._load().get(url)
+        return not rec or rec.get('retry_at', 0) <= time()
+
+    def record_success(self, url, latency):
+        with self._lock:
+            rec = self._load().setdefault(url, {})
+            rec['last_success'] = time()
+            rec['latency'] = latency
+            rec['failures'] = 0
+            rec['retry_at'] = 0
+
+    def record_failure(self, url):
+        with self._lock:
+            rec = self._load().setdefault(url, {})
+            rec['failures'] = rec.get('failures', 0) + 1
+            rec['retry_at'] = time() + min(self.backoff_max, self.backoff_base * 2 ** (rec['failures'] - 1))
+
+    # Index file the source was found to publish (see remote.fetch_index()), None if unknown or due for a recheck
+    def index_format(self, url):
+        with self._lock:
+            rec = self._load().get(url)
+        if not rec or rec.get('format_checked', 0) + FORMAT_TTL <= time():
+            return None
+        return rec.get('index_format')
+
+    def record_index_format(self, url, name):
+        with self._lock:
+            rec = self._load().setdefault(url, {})
+            rec['index_format'] = name
+            rec['format_checked'] = time()
@@ -0,0 +1,127 @@
+import io
+import hashlib
+
+from socket import timeout as SocketTimeout
+from urllib.request import urlopen, Request
+from urllib.error import URLError
+
+from .download import STALL_TIMEOUT
+
+# Forward gaps up to this size are read through instead of opening a new request
+SKIP_LIMIT = 262144
+
+
+# Read-only seekable file object over an HTTP resource, backed by Range requests,
+# so that ZipFile can work with a remote archive directly: opening it fetches just
+# the central directory, and members read in archive order arrive as a single stream.
+# Bytes passing by in order are hashed, hexdigest() fetches whatever was skipped.
+class HTTPRangeFile(io.RawIOBase):
+    def __init__(self, url, size, algo='sha1', progress=None, throttle=None):
+        super().__init__()
+        self.url = url
+        self.size = size
+        self.progress = progress  # callable(bytes received in order, size)
+        self.throttle = throttle  # callable(bytes received), may sleep to limit the rate
+        self._pos = 0
+        self._resp = None
+        self._resp_pos = 0
+        self._hash = hashlib.new(algo)
+        self._hashed = 0
+
+    # Returns HTTPRangeFile, or None when the server does not support ranges
+    @staticmethod
+    def open(url, algo='sha1', progress=None, throttle=None):
+        try:
+            with urlopen(Request(url, headers={'Range': 'bytes=0-0'}), timeout=STALL_TIMEOUT) as resp:
+                if not resp.status == 206:
+                    return None
+                rng = resp.info().get('Content-Range', '')
+        except (URLError, SocketTimeout, ConnectionError):
+            return None
+
+        total = rng.split('/')[-1]
+        if not rng.startswith('bytes ') or not total.isdigit():
+            return None
+        return HTTPRangeFile(url, int(total), algo, progress, throttle)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position')
+        self._pos = offset
+        return self._pos
+
+    def _open_at(self, pos):
+        self._close_resp()
+        resp = urlopen(Request(self.url, headers={'Range': 'bytes=' + str(pos) + '-'}), timeout=STALL_TIMEOUT)
+        if not resp.status == 206:
+            resp.close()
+            raise URLError('Range request ignored by the server')
+        self._resp = resp
+        self._resp_pos = pos
+
+    def _close_resp(self):
+        if self._resp:
+            self._resp.close()
+            self._resp = None
+
+    def _consume(self, n):
+        data = self._resp.read(n)
+        if self.throttle and data:
+            self.throttle(len(data))
+        if self._resp_pos == self._hashed and data:
+            self._hash.update(data)
+            self._hashed += len(data)
+            if self.progress:
+                self.progress(self._hashed, self.size)
+        self._resp_pos += len(data)
+        return data
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self._pos)
+        if n <= 0:
+            return 0
+
+        gap = self._pos - self._resp_pos
+        if not self._resp or gap < 0 or gap > SKIP_LIMIT:
+            self._open_at(self._pos)
+        elif gap:
+            while self._resp_pos < self._pos:
+                if not self._consume(self._pos - self._resp_pos):
+                    raise URLError('Unexpected end of data')
+
+        got = 0
+        while got < n:
+            data = self._consume(n - got)
+            if not data:
+                raise URLError('Unexpected end of data')
+            b[got:got + len(data)] = data
+            got += len(data)
+        self._pos += got
+        return got
+
+    # Returns digest of the whole resource, fetching bytes that have not passed by in order
+    def hexdigest(self):
+        if self._hashed < self.size:
+            if not self._resp or not self._resp_pos == self._hashed:
+                self._open_at(self._hashed)
+            while self._hashed < self.size:
+                if not self._consume(min(131072, self.size - self._hashed)):
+                    raise URLError('Unexpected end of data')
+        return self._hash.hexdigest()
+
+    def close(self):
+        self._close_resp()
+        super().close()
@@ -0,0 +1,100 @@
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no cross-process locking on this platform
+
+# Advisory locks over lock files (flock), shared between readers and exclusive
+# for writers. Every thread opens its own descriptor, so threads of one process
+# exclude each other just like separate processes do. Locks are reentrant per
+# thread: nested requests for a lock already held pass, an exclusive request
+# under a shared one upgrades it until the inner block is left. Upgrading is not
+# atomic: flock drops the shared lock first, so another process may take the lock
+# in between. Whatever the shared lock protects has to be rechecked after upgrading,
+# or guarded with a lock of its own.
+#
+# Usage: with locks.FileLock(path, exclusive=True): ...
+# Non-blocking: with locks.FileLock(path, True, False) as lock: if lock.acquired: ...
+
+_local = threading.local()
+
+
+class _Held(object):
+    __slots__ = ('fd', 'modes')
+
+    def __init__(self, fd, mode):
+        self.fd = fd
+        self.modes = [mode]  # True for exclusive, innermost last
+
+
+def _held():
+    held = getattr(_local, 'held', None)
+    if held is None:
+        held = _local.held = {}
+    return held
+
+
+def _flock(fd, exclusive, blocking):
+    if fd is None:
+        return True
+    op = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    if not blocking:
+        op |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(fd, op)
+    except BlockingIOError:
+        return False
+    return True
+
+
+class FileLock(object):
+    def __init__(self, path, exclusive=False, blocking=True):
+        self.path = os.path.abspath(path)
+        self.exclusive = exclusive
+        self.blocking = blocking
+        self.acquired = False
+
+    # Returns False if not blocking and the lock is busy
+    def acquire(self):
+        held = _held().get(self.path)
+        if held:
+            if held.modes[-1] or not self.exclusive:
+                held.modes.append(held.modes[-1])
+                return True
+            # Upgrading; flock drops the shared lock if a non-blocking upgrade fails, so none is tried
+            if not self.blocking or not _flock(held.fd, True, True):
+                return False
+            held.modes.append(True)
+            return True
+
+        fd = None
+        if fcntl:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            if not _flock(fd, self.exclusive, self.blocking):
+                os.close(fd)
+                return False
+        _held()[self.path] = _Held(fd, self.exclusive)
+        return True
+
+    def release(self):
+        held = _held()[self.path]
+        exclusive = held.modes.pop()
+        if not held.modes:
+            del _held()[self.path]
+            if held.fd is not None:
+                fcntl.flock(held.fd, fcntl.LOCK_UN)
+                os.close(held.fd)
+        elif exclusive and not held.modes[-1]:
+            _flock(held.fd, False, True)  # back to shared
+
+    def __enter__(self):
+        self.acquired = self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        if self.acquired:
+            self.release()
+            self.acquired = False
+        return False
@@ -0,0 +1,55 @@
+from time import time
+from urllib.parse import urlsplit
+
+from .store import JSONStore
+
+# Weight of the most recent measurement in moving averages
+ALPHA = 0.3
+
+
+# Latency and throughput history of download hosts, persisted in the repository
+class MirrorStats(JSONStore):
+    def __init__(self, path, min_throughput=16384, grace=5.0):
+        super().__init__(path)
+        self.min_throughput = min_throughput  # bytes/sec, below that a transfer moves to the next mirror
+        self.grace = grace  # seconds of transfer before throughput is judged
+
+    @staticmethod
+    def host(link):
+        parts = urlsplit(link)
+        return parts.netloc or parts.scheme
+
+    # Expected transfer rate, hosts never tried are optimistically put first
+    def score(self, link):
+        with self._lock:
+            rec = self._load().get(self.host(link))
+        if not rec:
+            return float('inf')
+        return rec['throughput'] / (1 + rec['failures'])
+
+    # Returns links sorted from the most to the least promising, ties keep their order
+    def rank(self, links):
+        return sorted(links, key=lambda x: -self.score(x))
+
+    def record(self, link, latency, nbytes, seconds):
+        if seconds <= 0 or nbytes <= 0:
+            return
+        throughput = nbytes / seconds
+        with self._lock:
+            hosts = self._load()
+            rec = hosts.get(self.host(link))
+            if not rec:
+                rec = hosts[self.host(link)] = {'latency': latency, 'throughput': throughput}
+            else:
+                rec['latency'] += ALPHA * (latency - rec['latency'])
+                rec['throughput'] += ALPHA * (throughput - rec['throughput'])
+            rec['failures'] = 0
+            rec['updated'] = time()
+
+    # Stalled, too slow, or failed transfer
+    def record_failure(self, link):
+        with self._lock:
+            hosts = self._load()
+            rec = hosts.setdefault(self.host(link), {'latency': 0.0, 'throughput': 0.0, 'failures': 0})
+            rec['failures'] = rec.get('failures', 0) + 1
+            rec['updated'] = time()
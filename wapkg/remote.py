@@ -1,51 +1,474 @@
+import os
+import sys
+import gzip
 import json
+import zlib
+import hashlib
 
-from urllib.request import urlopen
-from urllib.error import URLError
+from time import time
+from socket import timeout as SocketTimeout
+from urllib.request import urlopen, Request
+from urllib.error import URLError, HTTPError
 from urllib.parse import urljoin
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import trace
+from .store import write_atomic
+
 VERSION_REQUIRED = 3
 EXTERNAL_LIST = 'https://pastebin.com/raw/aKjmATab'
+DELTA_DIR = 'index.delta'
 
+# Seconds to wait for a source to respond, so that a black-holed host can not hang everything
+SOURCE_TIMEOUT = 15
+# Seconds the external sources list is reused for before being fetched again
+EXTERNAL_TTL = 24 * 3600
+
+_NET_ERRORS = (URLError, SocketTimeout, ConnectionError)
+
+# Sources which turned out to publish plain index.json only, when there is no health record to keep it in
+_plain_only = set()
+
+_DECOMPRESS_ERRORS = (OSError, EOFError, zlib.error)
+if zstandard:
+    _DECOMPRESS_ERRORS += (zstandard.ZstdError,)
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+# Pre-compressed index files a source may publish next to index.json, most preferred first
+def _compressed_formats():
+    formats = [('index.json.gz', gzip.decompress)]
+    if zstandard:
+        formats.insert(0, ('index.json.zst', _zstd_decompress))
+    return formats
+
+
+def _not_published(e):
+    if isinstance(e, HTTPError):
+        return e.code in (403, 404, 410)
+    return isinstance(e.reason, FileNotFoundError)  # file:// sources
 
-# Returns repo index dictionary object, or None in case of failure
-def fetch_index(repo_url):
-    try:
-        with urlopen(urljoin(repo_url, 'index.json')) as index_req:
-            index = json.loads(index_req.read().decode('utf-8'))
-    except URLError:
-        return None
 
+def _remember_format(repo_url, health, name):
+    if health:
+        health.record_index_format(repo_url, name)
+    elif name == 'index.json':
+        _plain_only.add(repo_url)
+
+
+# Returns raw index.json content, preferring compressed variants when the source has them.
+# The variant found is remembered (in health, see health.SourceHealth), so that later
+# fetches go for it straight away instead of probing the ones the source lacks.
+def _download_index(repo_url, timeout=SOURCE_TIMEOUT, health=None):
+    known = health.index_format(repo_url) if health else None
+    if not health and repo_url in _plain_only:
+        known = 'index.json'
+
+    if not known == 'index.json':
+        formats = _compressed_formats()
+        formats.sort(key=lambda x: not x[0] == known)  # known one first, the rest as a fallback
+        for name, decompress in formats:
+            try:
+                with urlopen(urljoin(repo_url, name), timeout=timeout) as req:
+                    data = req.read()
+            except URLError as e:
+                if not _not_published(e):
+                    raise
+                continue
+            try:
+                data = decompress(data)
+            except _DECOMPRESS_ERRORS:
+                continue
+            if not name == known:
+                _remember_format(repo_url, health, name)
+            return data
+        _remember_format(repo_url, health, 'index.json')
+
+    req = Request(urljoin(repo_url, 'index.json'), headers={'Accept-Encoding': 'gzip'})
+    with urlopen(req, timeout=timeout) as index_req:
+        data = index_req.read()
+        if index_req.info().get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+    return data
+
+
+def _check_index(repo_url, index):
     if 'repo' not in index or not index['repo'] == 'wapkg':
-        return None
+        return False
     if not index['version'] == VERSION_REQUIRED:
         if index['version'] > VERSION_REQUIRED:
             print("! Source '" + repo_url + "' requires newer version of wapkg, " +
                   'consider upgrading your software in order to use this repo.')
+        return False
+    return True
+
+
+def _fetch_json(url, timeout=SOURCE_TIMEOUT):
+    with urlopen(url, timeout=timeout) as req:
+        return json.loads(req.read().decode('utf-8'))
+
+
+# Path of the cached index copy for the source
+def cached_index_path(cache_dir, repo_url):
+    return os.path.join(cache_dir, hashlib.sha1(repo_url.encode('utf-8')).hexdigest() + '.json')
+
+
+def load_cached_index(cache_dir, repo_url):
+    try:
+        with open(cached_index_path(cache_dir, repo_url), 'r') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _store_cached_index(cache_dir, repo_url, index):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    write_atomic(cached_index_path(cache_dir, repo_url), json.dumps(index))
+
+
+# Shortest chain of [from, to] delta steps leading from one generation to another, or None
+def _delta_chain(deltas, frm, to):
+    paths = {frm: []}
+    queue = [frm]
+    while queue:
+        g = queue.pop(0)
+        if g == to:
+            return paths[g]
+        for step in deltas:
+            if not isinstance(step, list) or not len(step) == 2 or not all(isinstance(x, int) for x in step):
+                continue
+            if step[0] == g and step[1] not in paths and step[1] <= to:
+                paths[step[1]] = paths[g] + [step]
+                queue.append(step[1])
+    return None
+
+
+def apply_delta(index, delta):
+    for section in ('packages', 'distributions'):
+        target = index.setdefault(section, {})
+        for name, entry in delta.get(section, {}).items():
+            if entry is None:
+                target.pop(name, None)
+            else:
+                target[name] = entry
+    index['generation'] = delta['to']
+
+
+# Brings the cached copy up to date using published deltas.
+# Returns updated index, or None when a full fetch is required.
+# Network errors other than deltas not being published are passed through.
+def _update_cached_index(repo_url, cached, timeout=SOURCE_TIMEOUT):
+    gen = cached.get('generation')
+    if not isinstance(gen, int):
+        return None
+
+    try:
+        head = _fetch_json(urljoin(repo_url, DELTA_DIR + '/head.json'), timeout)
+    except URLError as e:
+        if _not_published(e):
+            return None
+        raise
+    except ValueError:
         return None
+    if not isinstance(head, dict) or not isinstance(head.get('generation'), int):
+        return None  # malformed, full fetch
+    if head['generation'] == gen:
+        return cached
+
+    deltas = head.get('deltas', [])
+    if not isinstance(deltas, list):
+        return None
+    chain = _delta_chain(deltas, gen, head['generation'])
+    if not chain:
+        return None
+
+    with trace.span('apply_deltas', steps=len(chain)):
+        for frm, to in chain:
+            try:
+                delta = _fetch_json(urljoin(repo_url, DELTA_DIR + '/' + str(frm) + '-' + str(to) + '.json'), timeout)
+            except (URLError, ValueError):
+                return None
+            if not isinstance(delta, dict) or not delta.get('from') == frm or not delta.get('to') == to:
+                return None
+            apply_delta(cached, delta)
+
+    return cached
+
 
+# Returns repo index dictionary object, or None in case of failure.
+# With cache_dir given, the index is kept there and refreshed through deltas when possible,
+# and the kept copy is returned when the source can not be reached.
+# With health (health.SourceHealth) given, sources that keep failing are not contacted
+# until their backoff window is over.
+def fetch_index(repo_url, cache_dir=None, health=None, timeout=SOURCE_TIMEOUT):
+    with trace.span('fetch_index', source=repo_url) as sp:
+        cached = None
+        if cache_dir:
+            cached = load_cached_index(cache_dir, repo_url)
+            if cached and not _check_index(repo_url, cached):
+                cached = None
+
+        if health and not health.available(repo_url):
+            sp.set(skipped=True)
+            return cached
+
+        started = time()
+        try:
+            if cached:
+                gen = cached.get('generation')
+                index = _update_cached_index(repo_url, cached, timeout)
+                if index:
+                    sp.set(cached=True)
+                    if not index['generation'] == gen:
+                        _store_cached_index(cache_dir, repo_url, index)
+                    _record_health(health, repo_url, started)
+                    return index
+
+            data = _download_index(repo_url, timeout, health)
+            sp.set(bytes=len(data))
+        except _NET_ERRORS:
+            if health:
+                health.record_failure(repo_url)
+                health.save()
+            sp.set(failed=True)
+            return cached
+
+    _record_health(health, repo_url, started)
+    index = json.loads(data.decode('utf-8'))
+    if not _check_index(repo_url, index):
+        return None
+
+    if cache_dir:
+        _store_cached_index(cache_dir, repo_url, index)
     return index
 
 
-def fetch_external_sources():
+def _record_health(health, url, started):
+    if health:
+        health.record_success(url, time() - started)
+        health.save()
+
+
+# Compact index representation: records with __slots__ instead of nested
+# dicts, names interned. Records also act as read-only mappings over their
+# non-empty fields, so code written against raw index dicts keeps working.
+class _Record(object):
+    __slots__ = ()
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def __getitem__(self, key):
+        if key in self:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return getattr(self, key)
+        return default
+
+    def keys(self):
+        return [k for k in self.__slots__ if k in self]
+
+
+def _intern(s):
+    if s is None:
+        return None
+    return sys.intern(s)
+
+
+class PackageRecord(_Record):
+    __slots__ = ('revision', 'path', 'uri', 'sha1', 'group', 'description', 'requirements', 'switch')
+
+    def __init__(self, pkg):
+        self.revision = pkg.get('revision')
+        self.path = _intern(pkg.get('path'))
+        self.uri = pkg.get('uri')
+        self.sha1 = pkg.get('sha1')
+        self.group = _intern(pkg.get('group'))
+        self.description = pkg.get('description')
+        self.requirements = None
+        self.switch = None
+
+        if 'requirements' in pkg:
+            self.requirements = tuple(sys.intern(r) for r in pkg['requirements'])
+        if 'switch' in pkg:
+            # ((version strings, record), ...), in the original order
+            self.switch = tuple((tuple(sys.intern(v) for v in key.split(',')), PackageRecord(variant))
+                                for key, variant in pkg['switch'].items())
+
+    # Same as select_pkg()
+    def select(self, vs):
+        if self.switch is None:
+            return self
+        if not vs:
+            return None
+
+        fallback = None
+        for versions, variant in self.switch:
+            if vs in versions:
+                return variant
+            if versions == ('*',):
+                fallback = variant
+        return fallback
+
+
+class DistributionRecord(_Record):
+    __slots__ = ('path', 'uri', 'sha1')
+
+    def __init__(self, dist):
+        self.path = _intern(dist.get('path'))
+        self.uri = dist.get('uri')
+        self.sha1 = dist.get('sha1')
+
+
+class CompactIndex(_Record):
+    __slots__ = ('repo', 'version', 'generation', 'packages', 'distributions')
+
+    def __init__(self, index):
+        self.repo = index['repo']
+        self.version = index['version']
+        self.generation = index.get('generation')
+        self.packages = dict((sys.intern(name), PackageRecord(pkg))
+                             for name, pkg in index.get('packages', {}).items())
+        self.distributions = dict((sys.intern(name), DistributionRecord(dist))
+                                  for name, dist in index.get('distributions', {}).items())
+
+
+# Returns approximate number of bytes taken by objects reachable from obj
+# (records, containers, strings), each shared object counted once
+def footprint(obj):
+    seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if o is None or id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set)):
+            stack.extend(o)
+        elif isinstance(o, _Record):
+            stack.extend(getattr(o, k) for k in o.__slots__)
+        elif hasattr(o, '__dict__') and not isinstance(o, type):
+            stack.append(vars(o))
+    return total
+
+
+# Converts fetched index dictionary to CompactIndex, passes None through
+def compact_index(index):
+    if index is None:
+        return None
+    return CompactIndex(index)
+
+
+# Remembers fetched indexes (in compact form), so that a sequence of
+# operations hits every source only once
+class IndexCache(object):
+    def __init__(self, cache_dir=None, health=None, timeout=SOURCE_TIMEOUT):
+        self.cache_dir = cache_dir
+        self.health = health
+        self.timeout = timeout
+        self._indexes = {}
+
+    # Same as fetch_index(), but returns CompactIndex; failures are remembered too
+    def fetch(self, repo_url):
+        if repo_url not in self._indexes:
+            self._indexes[repo_url] = compact_index(fetch_index(repo_url, self.cache_dir, self.health, self.timeout))
+        return self._indexes[repo_url]
+
+    def clear(self):
+        self._indexes.clear()
+
+
+# cache_path: optional file to keep the list in; it is reused for ttl seconds,
+# and also returned (however old) when the list can not be fetched.
+# health: optional health.SourceHealth, see fetch_index()
+def fetch_external_sources(cache_path=None, ttl=EXTERNAL_TTL, health=None, timeout=SOURCE_TIMEOUT):
+    cached = None
+    if cache_path:
+        try:
+            with open(cache_path, 'r') as f:
+                cached = json.loads(f.read())
+        except (OSError, ValueError):
+            pass
+        if cached and time() - cached.get('fetched', 0) < ttl:
+            return cached['sources']
+
+    stale = cached['sources'] if cached else []
+    if health and not health.available(EXTERNAL_LIST):
+        return stale
+
     sources = []
+    started = time()
     try:
-        with urlopen(EXTERNAL_LIST) as lst_req:
+        with urlopen(EXTERNAL_LIST, timeout=timeout) as lst_req:
             for src in lst_req.read().decode('utf-8').split('\n'):
                 src_ = src.strip()
                 if len(src_) and not src_.startswith('#'):
                     sources.append(src_)
-    except URLError:
-        pass
+    except _NET_ERRORS:
+        if health:
+            health.record_failure(EXTERNAL_LIST)
+            health.save()
+        return stale
 
+    _record_health(health, EXTERNAL_LIST, started)
+    if cache_path:
+        write_atomic(cache_path, json.dumps({'fetched': time(), 'sources': sources}))
     return sources
 
 
+# Returns download link of a package or distribution entry, None if it has none
+def entry_link(repo_url, entry):
+    if 'path' in entry:
+        return urljoin(repo_url, entry['path'])
+    if 'uri' in entry:
+        return entry['uri']
+    return None
+
+
+# Returns links to the same archive as entry (identified by sha1) found in any of the sources.
+# fetch(src) returns an index, lookup(index) returns the corresponding entry or None.
+def find_mirrors(entry, sources, fetch, lookup):
+    if 'sha1' not in entry:
+        return []
+
+    links = []
+    for src in sources:
+        index = fetch(src)
+        if not index:
+            continue
+        alt = lookup(index)
+        if not alt or 'sha1' not in alt or not alt['sha1'].lower() == entry['sha1'].lower():
+            continue
+        link = entry_link(src, alt)
+        if link and link not in links:
+            links.append(link)
+    return links
+
+
 # Unwraps the 'switch' content
 def select_pkg(pkg, vs):
     if not pkg:
         return None
 
+    if isinstance(pkg, PackageRecord):
+        return pkg.select(vs)
+
     if 'switch' in pkg:
         if not vs:
             return None
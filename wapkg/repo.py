@@ -2,16 +2,28 @@ import os
 import sys
 import json
 import ctypes
+import shutil
 import sqlite3
 
+from sys import stdout
 from uuid import uuid4
+from socket import timeout as SocketTimeout
+from concurrent.futures import ThreadPoolExecutor
 from zipfile import ZipFile
 from urllib.error import URLError
-from urllib.parse import urljoin
 
+from . import archive
+from . import locks
 from . import remote
+from . import schema
+from . import trace
+from .clone import clone_tree
+from .unzip import extract_members
 from .distro import Distribution
-from .download import Downloader
+from .download import Downloader, SharedDownloads, DownloadScheduler, PRIORITY_BACKGROUND
+from .health import SourceHealth
+from .httpfile import HTTPRangeFile
+from .mirrors import MirrorStats
 
 
 class Repository(object):
@@ -36,40 +48,83 @@ class Repository(object):
                     settings['sources'] = default_sources
                 f.write(json.dumps(settings, indent=4))
 
-        for x in os.listdir(self.wd):
-            p = os.path.join(self.wd, x)
-            if os.path.isfile(p) and x.endswith('.download'):
-                os.unlink(p)
-
         self.settings = {}
         with open(self.sf, 'r') as f:
             self.settings = json.loads(f.read())
         if 'path' in self.settings:
             self.wd = self.settings['path']
 
+        # Leftovers of interrupted downloads, unless some other process is downloading right now
+        with self.lock(True, False) as lock:
+            if lock.acquired:
+                for x in os.listdir(self.wd):
+                    p = os.path.join(self.wd, x)
+                    if os.path.isfile(p) and x.endswith('.download'):
+                        os.unlink(p)
+        self.index_cache_dir = os.path.join(self.wd, 'indexes')
+        self.archive_dir = os.path.join(self.wd, 'archived')
+        self.source_health = SourceHealth(os.path.join(self.wd, 'health.json'))
+        self.source_timeout = self.settings.get('source_timeout', remote.SOURCE_TIMEOUT)
+        self.mirror_stats = MirrorStats(os.path.join(self.wd, 'mirrors.json'),
+                                        self.settings.get('mirror_min_throughput', 16384))
+        self.scheduler = DownloadScheduler(self.settings.get('download_max_active', 4),
+                                           self.settings.get('download_max_per_host', 2),
+                                           self.settings.get('download_rate_limit', 0))
+
         self._extrnl_flag = False
 
+    # Shared lock for using the repository, exclusive for cleaning it up (see locks.FileLock).
+    # Distributions have their own locks (Distribution.lock()).
+    def lock(self, exclusive=False, blocking=True):
+        return locks.FileLock(os.path.join(self.wd, '.lock'), exclusive, blocking)
+
     def list_distributions(self):
         distro = []
-        for d in os.listdir(self.wd):
-            if os.path.exists(os.path.join(self.wd, d, '.wadist')):
-                distro.append(d)
+        with self.lock():
+            for d in os.listdir(self.wd):
+                if os.path.exists(os.path.join(self.wd, d, '.wadist')):
+                    distro.append(d)
 
         return distro
 
+    # Names of distributions packed with archive_distribution()
+    def list_archived_distributions(self):
+        if not os.path.isdir(self.archive_dir):
+            return []
+        return [x[:-len('.zip')] for x in os.listdir(self.archive_dir) if x.endswith('.zip')]
+
+    def _archive_paths(self, name):
+        return os.path.join(self.archive_dir, name + '.zip'), os.path.join(self.archive_dir, name + '.links')
+
     def get_distribution(self, name):
-        return Distribution(os.path.join(self.wd, name))
+        return Distribution(os.path.join(self.wd, name), self.mirror_stats, self.scheduler)
+
+    # Returns fresh remote.IndexCache backed by the repository's on-disk index copies
+    def get_index_cache(self):
+        return remote.IndexCache(self.index_cache_dir, self.source_health, self.source_timeout)
+
+    # Same as remote.fetch_index(), with the repository's index copies and source health
+    def fetch_index(self, repo_url):
+        return remote.fetch_index(repo_url, self.index_cache_dir, self.source_health, self.source_timeout)
 
     def get_sources(self):
         if not self._extrnl_flag:
             self._extrnl_flag = True
             if not ('disable_external_sources_list' in self.settings and self.settings['disable_external_sources_list']):
-                self.settings['sources'] += remote.fetch_external_sources()
+                self.settings['sources'] += remote.fetch_external_sources(
+                    os.path.join(self.wd, 'external_sources.json'),
+                    self.settings.get('external_sources_ttl', remote.EXTERNAL_TTL),
+                    self.source_health, self.source_timeout)
 
         return self.settings['sources']
 
+    # verified: file was checked against sha1 from the index (see unzip.extract_members())
     # Returns: succeeded, message, distro name
-    def install_dist_from_file(self, path, target_name=None):
+    def install_dist_from_file(self, path, target_name=None, verified=False):
+        with trace.span('install_dist_from_file', path=path), self.lock():
+            return self._install_dist_from_file(path, target_name, verified)
+
+    def _install_dist_from_file(self, path, target_name, verified):
         dist_name = None
         with ZipFile(path) as zf:
             wadist = json.loads(zf.read('wadist.json').decode('utf-8'))
@@ -85,39 +140,43 @@ class Repository(object):
                 return False, 'A distribution with such name already exists', None
 
             repo = os.path.join(target, '.wadist')
-            os.makedirs(os.path.join(repo, 'cache'))
-            if sys.platform == 'win32':
-                # Setting 'hidden' attribute
-                ctypes.windll.kernel32.SetFileAttributesW(repo, 2)
-            with open(os.path.join(repo, 'version'), 'w') as vf:
-                vf.write('1')
-            with sqlite3.connect(os.path.join(repo, 'packages.db')) as conn:
-                c = conn.cursor()
-                c.execute('CREATE TABLE packages(name char(64) primary key not null,revision uint not null)')
-                c.execute('CREATE TABLE paths('
-                          'path char(512) not null primary key,'
-                          'dir int(1) not null default 0,'
-                          'package char(64) not null,'
-                          'foreign key (package) references packages(name) on delete cascade'
-                          ');')
-                conn.commit()
-
-            for n in zf.namelist():
-                if n.startswith('wadist'):
-                    continue
-                zf.extract(n, target)
+            os.makedirs(repo)
+            # Taken before anything else is created inside, opening the distro waits for extraction
+            with locks.FileLock(os.path.join(repo, 'lock'), True):
+                try:
+                    os.mkdir(os.path.join(repo, 'cache'))
+                    if sys.platform == 'win32':
+                        # Setting 'hidden' attribute
+                        ctypes.windll.kernel32.SetFileAttributesW(repo, 2)
+                    with open(os.path.join(repo, 'version'), 'w') as vf:
+                        vf.write(str(schema.DISTRO_VERSION))
+                    with sqlite3.connect(os.path.join(repo, 'packages.db')) as conn:
+                        schema.migrate(conn)
+
+                    with trace.span('extract') as sp:
+                        names = [n for n in zf.namelist() if not n.startswith('wadist')]
+                        sp.set(**extract_members(zf, names, target, path, verified).as_dict())
+                except:
+                    # Not leaving half-extracted distro behind
+                    shutil.rmtree(target, ignore_errors=True)
+                    raise
 
         return True, 'Success', dist_name
 
-    def install_dist_by_name(self, name, sources, target_name=None, action=None):
+    # index_cache: optional remote.IndexCache to take indexes from
+    @trace.traced('install_dist_by_name')
+    def install_dist_by_name(self, name, sources, target_name=None, action=None, index_cache=None):
         target = name
         if target_name:
             target = target_name
         if os.path.exists(os.path.join(self.wd, target)):
             return False, 'A distribution with such name already exists', None
 
+        if not index_cache:
+            index_cache = self.get_index_cache()
+
         for src in sources:
-            index = remote.fetch_index(src)
+            index = index_cache.fetch(src)
             if not index:
                 continue
             if name not in index['distributions']:
@@ -126,25 +185,201 @@ class Repository(object):
             dist = index['distributions'][name]
 
             if 'path' in dist or 'uri' in dist:
-                if 'path' in dist:
-                    link = urljoin(src, dist['path'])
-                else:
-                    link = dist['uri']
-                path = os.path.join(self.wd, str(uuid4()) + '.download')
+                links = [remote.entry_link(src, dist)]
+                for link in remote.find_mirrors(dist, sources, index_cache.fetch,
+                                                lambda x: x['distributions'].get(name)):
+                    if link not in links:
+                        links.append(link)
                 hexdigest = None
                 if 'sha1' in dist:
                     hexdigest = dist['sha1']
-                try:
-                    Downloader().go(link, path, action).verify_sha1(hexdigest)
-                except URLError:
-                    continue
 
-                ok, msg, dn = self.install_dist_from_file(path, target_name)
-                os.unlink(path)
-                return ok, msg, dn
+                with self.lock():  # keeps cleanups off the file being downloaded
+                    if self.settings.get('stream_install', True):
+                        res = self._install_dist_streamed(self.mirror_stats.rank(links)[0], target_name,
+                                                          hexdigest, action)
+                        if res:
+                            return res
+
+                    path = os.path.join(self.wd, str(uuid4()) + '.download')
+                    try:
+                        downloader = Downloader(False, self.scheduler, PRIORITY_BACKGROUND)
+                        downloader.go_mirrors(links, path, action, self.mirror_stats).verify_sha1(hexdigest)
+                    except URLError:
+                        continue
+
+                    ok, msg, dn = self.install_dist_from_file(path, target_name, bool(hexdigest))
+                    os.unlink(path)
+                    return ok, msg, dn
 
         return False, 'No suitable distro source found', None
 
+    # Installs distro straight from a remote archive: wadist.json is checked right after
+    # the central directory is fetched, members are extracted as they arrive.
+    # Returns None when the server can not do that (no Range support, connection
+    # lost midway), so that the caller goes for a regular download.
+    def _install_dist_streamed(self, link, target_name, hexdigest, action):
+        if not link.startswith('http'):
+            return None
+
+        shown = [-1]
+
+        def progress(current, total):
+            kb = int(current / 131072) * 128
+            if current == total:
+                kb = int(total / 1024)
+            if kb == shown[0]:
+                return
+            shown[0] = kb
+            if action:
+                action.update_progress(kb, int(total / 1024))
+            stdout.write('\r- Streaming ' + link.split('/')[-1] + ', ' +
+                         str(kb) + '/' + str(int(total / 1024)) + ' KB')
+
+        rf = HTTPRangeFile.open(link, progress=progress, throttle=self.scheduler.throttle)
+        if not rf:
+            return None
+
+        slot = self.scheduler.acquire(link, PRIORITY_BACKGROUND, action)
+        with trace.span('install_dist_streamed', link=link):
+            try:
+                ok, msg, dn = self.install_dist_from_file(rf, target_name)
+                if ok and hexdigest:
+                    try:
+                        with trace.span('verify'):
+                            digest = rf.hexdigest()
+                    except:
+                        # Unverified distro is not kept, the fallback download installs it again
+                        shutil.rmtree(os.path.join(self.wd, dn), ignore_errors=True)
+                        raise
+                    if not digest == hexdigest.lower():
+                        shutil.rmtree(os.path.join(self.wd, dn))
+                        print()
+                        raise RuntimeError('Checksum does not match')
+            except (URLError, SocketTimeout, ConnectionError):
+                print()
+                return None
+            finally:
+                rf.close()
+                self.scheduler.release(slot)
+
+        print()  # newline
+        return ok, msg, dn
+
+    # Makes a new distribution sharing unchanged files with an existing one (reflinks
+    # where the filesystem supports them, copies otherwise), copying the package database
+    # so ownership carries over. hardlinks=True shares files on any filesystem, but files
+    # rewritten in place outside clone.GAME_WRITABLE then change in both distros.
+    # Returns: succeeded, message
+    def clone_distribution(self, name, new_name, hardlinks=False):
+        if name not in self.list_distributions():
+            return False, 'No such distribution installed'
+        target = os.path.join(self.wd, new_name)
+        if os.path.exists(target):
+            return False, 'A distribution with such name already exists'
+
+        src = os.path.join(self.wd, name)
+        with trace.span('clone_distribution') as sp, locks.FileLock(os.path.join(src, '.wadist', 'lock')):
+            try:
+                stats = clone_tree(src, target, hardlinks, skip=[os.path.join('.wadist', 'cache')])
+            except OSError:
+                shutil.rmtree(target, ignore_errors=True)
+                raise
+            sp.set(**stats)
+
+        repo = os.path.join(target, '.wadist')
+        os.makedirs(os.path.join(repo, 'cache'), exist_ok=True)
+        if sys.platform == 'win32':
+            ctypes.windll.kernel32.SetFileAttributesW(repo, 2)
+
+        return True, 'Success (' + ', '.join(k + ': ' + str(v) for k, v in sorted(stats.items()) if v) + ')'
+
+    # Packs distribution into the repository's archive directory and removes it.
+    # Returns: succeeded, message
+    def archive_distribution(self, name):
+        if name not in self.list_distributions():
+            return False, 'No such distribution installed'
+        if name in self.list_archived_distributions():
+            return False, 'An archived distribution with such name already exists'
+
+        src = os.path.join(self.wd, name)
+        path, links = self._archive_paths(name)
+        tmp = path + '.' + uuid4().hex + '.tmp'
+        os.makedirs(self.archive_dir, exist_ok=True)
+        with trace.span('archive_distribution') as sp, self.get_distribution(name).lock(True):
+            try:
+                stats = archive.pack_tree(src, tmp, links, skip=[os.path.join('.wadist', 'cache')])
+            except:
+                archive.remove_archive(tmp, links)
+                raise
+            os.replace(tmp, path)
+            sp.set(**stats)
+            # Moved away at once, deleting takes a while and openers waiting for the lock recheck the path
+            trash = os.path.join(self.archive_dir, name + '.' + uuid4().hex + '.removing')
+            os.rename(src, trash)
+        shutil.rmtree(trash)
+
+        size = int(os.path.getsize(path) / 1024)
+        return True, 'Success (' + str(stats['files']) + ' files, ' + str(int(stats['bytes'] / 1024)) + \
+            ' KB packed into ' + str(size) + ' KB, ' + str(stats['linked']) + ' kept as hardlinks)'
+
+    # Unpacks distribution archived with archive_distribution().
+    # Returns: succeeded, message
+    def restore_distribution(self, name, jobs=4):
+        if name not in self.list_archived_distributions():
+            return False, 'No such distribution archived'
+        target = os.path.join(self.wd, name)
+        if os.path.exists(target):
+            return False, 'A distribution with such name already exists'
+
+        path, links = self._archive_paths(name)
+        tmp = os.path.join(self.archive_dir, name + '.' + uuid4().hex + '.restoring')
+        with trace.span('restore_distribution') as sp, self.lock():
+            try:
+                stats = archive.unpack_tree(path, links, tmp, jobs)
+                os.makedirs(os.path.join(tmp, '.wadist', 'cache'), exist_ok=True)
+                if sys.platform == 'win32':
+                    ctypes.windll.kernel32.SetFileAttributesW(os.path.join(tmp, '.wadist'), 2)
+                os.rename(tmp, target)
+            except:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+            sp.set(**stats)
+            archive.remove_archive(path, links)
+
+        return True, 'Success (' + str(stats['files']) + ' files, ' + str(stats['linked']) + ' relinked)'
+
+    # Installs packages (names or local files) into several distributions at once.
+    # Every archive is downloaded once, switch blocks are resolved per distro,
+    # distributions are processed in parallel.
+    # Returns {distro name: [(package, succeeded, message), ...]}
+    def install_packages_into(self, dist_names, packages, sources, index_cache=None, jobs=4):
+        if not index_cache:
+            index_cache = self.get_index_cache()
+        for src in sources:
+            index_cache.fetch(src)  # warming up before going parallel
+
+        downloads = SharedDownloads(self.wd, self.mirror_stats, self.scheduler)
+
+        def install(dist_name):
+            results = []
+            dist = self.get_distribution(dist_name)
+            for pkg in packages:
+                if os.path.exists(pkg) and os.path.isfile(pkg):
+                    ok, msg = dist.install_package_from_file(pkg)
+                else:
+                    ok, msg = dist.install_package_by_name(pkg, sources, index_cache=index_cache,
+                                                           downloads=downloads)
+                results.append((pkg, ok, msg))
+            return results
+
+        try:
+            with trace.span('install_packages_into', dists=len(dist_names)), self.lock():
+                with ThreadPoolExecutor(max(1, jobs)) as pool:
+                    return dict(zip(dist_names, pool.map(install, dist_names)))
+        finally:
+            downloads.clean()
+
     def write_settings(self):
         with open(self.sf, 'w+') as f:
             f.write(json.dumps(self.settings, sort_keys=True, indent=4))
@@ -0,0 +1,56 @@
+# packages.db schema. Distributions are upgraded in place when opened: every
+# migration below brings the database one version up, the version reached is
+# kept in PRAGMA user_version (0 for databases made before migrations existed).
+
+# .wadist layout version, written to .wadist/version; older layouts are upgraded on open
+DISTRO_VERSION = 1
+
+
+def _base_tables(c):
+    c.execute('CREATE TABLE IF NOT EXISTS packages(name char(64) primary key not null,revision uint not null)')
+    c.execute('CREATE TABLE IF NOT EXISTS paths('
+              'path char(512) not null primary key,'
+              'dir int(1) not null default 0,'
+              'package char(64) not null,'
+              'foreign key (package) references packages(name) on delete cascade'
+              ');')
+
+
+def _package_index(c):
+    # Serves both 'WHERE package=?' and 'WHERE package=? AND dir=...' lookups
+    c.execute('CREATE INDEX IF NOT EXISTS paths_package_dir ON paths(package, dir)')
+
+
+def _file_metadata(c):
+    # Uncompressed size and CRC-32 of installed files, as recorded in package archives
+    c.execute('ALTER TABLE paths ADD COLUMN size int')
+    c.execute('ALTER TABLE paths ADD COLUMN crc int')
+
+
+MIGRATIONS = [_base_tables, _package_index, _file_metadata]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+# Brings the database up to SCHEMA_VERSION.
+# Raises RuntimeError if it was made by a newer wapkg.
+def migrate(conn):
+    if get_version(conn) == SCHEMA_VERSION:
+        return
+
+    conn.execute('BEGIN IMMEDIATE')  # other processes wait instead of migrating concurrently
+    try:
+        version = get_version(conn)
+        if version > SCHEMA_VERSION:
+            raise RuntimeError('Package database was made by a newer wapkg version')
+        c = conn.cursor()
+        for i in range(version, SCHEMA_VERSION):
+            MIGRATIONS[i](c)
+        c.execute('PRAGMA user_version=' + str(SCHEMA_VERSION))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
@@ -0,0 +1,169 @@
+import os
+import re
+import json
+import hashlib
+
+from bisect import bisect_left
+
+from . import remote
+from . import trace
+from .store import write_atomic
+
+# Token index over package names, groups and descriptions of a source.
+# Built once per index generation (or index content, for sources without
+# generations) and kept next to the cached index copy, so that searching
+# does not walk the whole index and works offline too.
+
+SEARCH_INDEX_VERSION = 1
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return _TOKEN_RE.findall(text.lower())
+
+
+def search_index_path(cache_dir, repo_url):
+    return remote.cached_index_path(cache_dir, repo_url)[:-len('.json')] + '.search.json'
+
+
+# Returns (group, description) of a package entry, looking into switch variants as well
+def _describe(pkg):
+    group, description = pkg.get('group'), pkg.get('description')
+    if 'switch' in pkg:
+        if isinstance(pkg, remote.PackageRecord):
+            variants = [v for _, v in pkg.switch]
+        else:
+            variants = pkg['switch'].values()
+        for v in variants:
+            group = group or v.get('group')
+            description = description or v.get('description')
+    return group, description
+
+
+# Identifies index content the search index was built from
+def _index_key(index):
+    gen = index.get('generation')
+    if isinstance(gen, int):
+        return 'generation:' + str(gen)
+
+    h = hashlib.sha1()
+    for name in sorted(index['packages']):
+        group, description = _describe(index['packages'][name])
+        h.update(json.dumps([name, group, description]).encode('utf-8'))
+    return 'sha1:' + h.hexdigest()
+
+
+class SearchIndex(object):
+    # packages: {name: [group, description]}, tokens: {token: [names]}
+    def __init__(self, key, packages, tokens):
+        self.key = key
+        self.packages = packages
+        self.tokens = tokens
+        self._sorted = sorted(tokens)
+
+    @staticmethod
+    def build(index, key=None):
+        packages = {}
+        tokens = {}
+        for name, pkg in index['packages'].items():
+            group, description = _describe(pkg)
+            packages[name] = [group, description]
+            words = set(tokenize(name) + tokenize(group) + tokenize(description))
+            words.add(name.lower())
+            for w in words:
+                tokens.setdefault(w, []).append(name)
+        if key is None:
+            key = _index_key(index)
+        return SearchIndex(key, packages, tokens)
+
+    # Returns SearchIndex, or None if file is missing or unusable
+    @staticmethod
+    def load(path):
+        try:
+            with open(path, 'r') as f:
+                data = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if not data.get('version') == SEARCH_INDEX_VERSION:
+            return None
+        return SearchIndex(data['key'], data['packages'], data['tokens'])
+
+    def save(self, path):
+        d = os.path.dirname(path)
+        if d and not os.path.exists(d):
+            os.makedirs(d, exist_ok=True)
+        write_atomic(path, json.dumps({
+            'version': SEARCH_INDEX_VERSION,
+            'key': self.key,
+            'packages': self.packages,
+            'tokens': self.tokens
+        }))
+
+    # Names of packages having a token starting with the word
+    def _lookup(self, word):
+        names = set()
+        i = bisect_left(self._sorted, word)
+        while i < len(self._sorted) and self._sorted[i].startswith(word):
+            names.update(self.tokens[self._sorted[i]])
+            i += 1
+        return names
+
+    # Returns names of packages matching every word of the query
+    def query(self, text):
+        words = tokenize(text)
+        if not words:
+            return []
+        found = None
+        for w in words:
+            names = self._lookup(w)
+            found = names if found is None else found & names
+            if not found:
+                return []
+        return list(found)
+
+
+# Returns SearchIndex of the source, building and storing it when the index given
+# is newer than the stored one. With index None (source unreachable), the stored
+# one is returned as is, or None if there is none.
+def get_search_index(cache_dir, repo_url, index):
+    path = search_index_path(cache_dir, repo_url)
+    stored = SearchIndex.load(path)
+    if index is None:
+        return stored
+
+    key = _index_key(index)
+    if stored and stored.key == key:
+        return stored
+
+    with trace.span('build_search_index', source=repo_url) as sp:
+        si = SearchIndex.build(index, key)
+        sp.set(packages=len(si.packages), tokens=len(si.tokens))
+    si.save(path)
+    return si
+
+
+# Searches packages of all the sources given.
+# search_indexes: list of (source, SearchIndex or None), in sources priority order.
+# Returns list of (name, group, description, source), best matches first.
+def search(text, search_indexes):
+    results = {}
+    for src, si in search_indexes:
+        if not si:
+            continue
+        for name in si.query(text):
+            if name not in results:
+                group, description = si.packages[name]
+                results[name] = (name, group, description, src)
+
+    words = tokenize(text)
+
+    def rank(res):
+        name_tokens = set(tokenize(res[0]))
+        name_tokens.add(res[0].lower())
+        in_name = all(any(t.startswith(w) for t in name_tokens) for w in words)
+        return not res[0].lower() == text.strip().lower(), not in_name, res[0].lower()
+
+    return sorted(results.values(), key=rank)
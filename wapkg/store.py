@@ -0,0 +1,49 @@
+import os
+import json
+import threading
+
+from uuid import uuid4
+
+
+# Replaces contents of the file at once: readers see either the old or the new version.
+# Temporary names are unique, so concurrent writers do not collide (the last one wins).
+# data: bytes or str (written as UTF-8)
+def write_atomic(path, data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    tmp = path + '.' + uuid4().hex + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+# Records keyed by name (source URL, host, ...) kept in a JSON file, loaded on first
+# use and written back by save(). Subclasses access them through _load() with _lock held.
+class JSONStore(object):
+    def __init__(self, path):
+        self.path = path
+        self._records = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._records is None:
+            self._records = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, 'r') as f:
+                        self._records = json.loads(f.read())
+                except ValueError:
+                    pass
+        return self._records
+
+    def save(self):
+        with self._lock:
+            if self._records is None:
+                return
+            data = json.dumps(self._records, sort_keys=True, indent=4)
+        write_atomic(self.path, data)
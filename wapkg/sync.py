@@ -0,0 +1,249 @@
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import threading
+
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen, Request
+from urllib.error import URLError, HTTPError
+from urllib.parse import urljoin, urlsplit
+
+from . import remote
+from . import trace
+from .download import STALL_TIMEOUT
+from .store import write_atomic
+
+MANIFEST = '.wapkg-mirror.json'
+
+
+# Relative path inside the mirror for an archive entry, None if the entry is unusable
+def _local_path(entry):
+    if 'path' in entry:
+        p = entry['path']
+        parts = p.split('/')
+        if p.startswith('/') or '..' in parts or ':' in parts[0]:
+            return None
+        return p
+    if 'uri' in entry:
+        name = urlsplit(entry['uri']).path.split('/')[-1] or 'archive'
+        return 'external/' + hashlib.sha1(entry['uri'].encode('utf-8')).hexdigest()[:16] + '/' + name
+    return None
+
+
+# Calls fn(entry) for every archive entry of an index or delta, switch variants included
+def _walk_entries(index, fn):
+    for pkg in index.get('packages', {}).values():
+        if not pkg:
+            continue
+        if 'switch' in pkg:
+            for variant in pkg['switch'].values():
+                fn(variant)
+        else:
+            fn(pkg)
+    for dist in index.get('distributions', {}).values():
+        if dist:
+            fn(dist)
+
+
+# Points 'uri' entries to their local copies
+def _rewrite(index):
+    def rewrite(entry):
+        if 'uri' in entry and 'path' not in entry:
+            entry['path'] = _local_path(entry)
+            del entry['uri']
+    _walk_entries(index, rewrite)
+    return index
+
+
+def _sha1_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class SyncResult(object):
+    def __init__(self):
+        self.fetched = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.bytes = 0
+        self.errors = []  # (path, message)
+        self.index_updated = False  # index is kept as it was when any archive failed
+        self._lock = threading.Lock()
+
+    def add(self, **counters):
+        with self._lock:
+            for k, v in counters.items():
+                setattr(self, k, getattr(self, k) + v)
+
+
+# Copies a source (index, deltas and every referenced archive) into target_dir, laid
+# out as a wapkg source itself. Re-running only fetches archives that changed.
+# When some archives fail, the mirror keeps publishing its previous index (and deltas),
+# along with every archive it references, until a run succeeds completely.
+# Returns SyncResult, or None when the source index cannot be fetched.
+def mirror_source(src, target_dir, jobs=8, log=None):
+    if not src.endswith('/'):
+        src += '/'
+
+    with trace.span('mirror', source=src):
+        index = remote.fetch_index(src)
+        if not index:
+            return None
+
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+
+        manifest_path = os.path.join(target_dir, MANIFEST)
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                manifest = json.loads(f.read())
+
+        wanted = {}
+
+        def collect(entry):
+            p = _local_path(entry)
+            if p:
+                wanted[p] = (remote.entry_link(src, entry), entry.get('sha1'))
+        _walk_entries(index, collect)
+
+        result = SyncResult()
+        new_manifest = {}
+        lock = threading.Lock()
+
+        def sync_one(p):
+            link, sha1 = wanted[p]
+            dest = os.path.join(target_dir, *p.split('/'))
+            rec = _sync_file(link, dest, sha1, manifest.get(p), result)
+            if not rec and p in manifest:
+                rec = manifest[p]  # previous copy is left in place, still listed by the previous index
+            if rec:
+                with lock:
+                    new_manifest[p] = rec
+                    if log and rec.get('fetched'):
+                        log('+ ' + p)
+
+        with trace.span('archives', count=len(wanted)):
+            with ThreadPoolExecutor(max(1, jobs)) as pool:
+                list(pool.map(sync_one, sorted(wanted)))
+
+        for p in manifest:
+            if p not in wanted:
+                if result.errors:
+                    new_manifest[p] = manifest[p]  # removed once the new index is published
+                    continue
+                dest = os.path.join(target_dir, *p.split('/'))
+                if os.path.exists(dest):
+                    os.unlink(dest)
+                result.add(removed=1)
+
+        for rec in new_manifest.values():
+            rec.pop('fetched', None)
+        write_atomic(manifest_path, json.dumps(new_manifest, sort_keys=True, indent=4))
+
+        if result.errors:
+            return result
+
+        _mirror_deltas(src, target_dir)
+
+        # Index goes last, so that clients never see entries whose archives are not there yet
+        data = json.dumps(_rewrite(index)).encode('utf-8')
+        write_atomic(os.path.join(target_dir, 'index.json.gz'), gzip.compress(data))
+        write_atomic(os.path.join(target_dir, 'index.json'), data)
+        result.index_updated = True
+
+    return result
+
+
+# Returns manifest record for the file, None in case of failure
+def _sync_file(link, dest, sha1, rec, result):
+    if sha1:
+        sha1 = sha1.lower()
+    headers = {}
+    if os.path.exists(dest):
+        size = os.path.getsize(dest)
+        if rec and rec.get('link') == link and rec.get('size') == size:
+            if sha1 and rec.get('sha1') == sha1:
+                result.add(unchanged=1)
+                return rec
+            if not sha1:
+                # Nothing to compare with, asking the server instead
+                if rec.get('etag'):
+                    headers['If-None-Match'] = rec['etag']
+                if rec.get('last_modified'):
+                    headers['If-Modified-Since'] = rec['last_modified']
+        elif sha1 and _sha1_file(dest) == sha1:
+            result.add(unchanged=1)
+            return {'link': link, 'sha1': sha1, 'size': size}
+
+    d = os.path.dirname(dest)
+    if not os.path.exists(d):
+        os.makedirs(d, exist_ok=True)
+
+    tmp = dest + '.' + uuid4().hex + '.part'  # concurrent runs do not share it
+    h = hashlib.sha1()
+    try:
+        with urlopen(Request(link, headers=headers), timeout=STALL_TIMEOUT) as resp:
+            with open(tmp, 'wb') as f:
+                for chunk in iter(lambda: resp.read(131072), b''):
+                    h.update(chunk)
+                    f.write(chunk)
+            info = resp.info()
+    except HTTPError as e:
+        if e.code == 304:
+            result.add(unchanged=1)
+            return rec
+        result.errors.append((dest, str(e)))
+        return None
+    except (URLError, OSError) as e:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        result.errors.append((dest, str(e)))
+        return None
+
+    if sha1 and not h.hexdigest() == sha1:
+        os.unlink(tmp)
+        result.errors.append((dest, 'Checksum does not match'))
+        return None
+
+    os.replace(tmp, dest)
+    size = os.path.getsize(dest)
+    result.add(fetched=1, bytes=size)
+    rec = {'link': link, 'sha1': h.hexdigest(), 'size': size, 'fetched': True}
+    if info.get('ETag'):
+        rec['etag'] = info.get('ETag')
+    if info.get('Last-Modified'):
+        rec['last_modified'] = info.get('Last-Modified')
+    return rec
+
+
+# Deltas are mirrored along (with the same rewriting), or dropped if the source has none
+def _mirror_deltas(src, target_dir):
+    delta_dir = os.path.join(target_dir, remote.DELTA_DIR)
+    try:
+        with urlopen(urljoin(src, remote.DELTA_DIR + '/head.json'), timeout=STALL_TIMEOUT) as req:
+            head = json.loads(req.read().decode('utf-8'))
+        deltas = {}
+        for frm, to in head.get('deltas', []):
+            name = str(frm) + '-' + str(to) + '.json'
+            with urlopen(urljoin(src, remote.DELTA_DIR + '/' + name), timeout=STALL_TIMEOUT) as req:
+                deltas[name] = _rewrite(json.loads(req.read().decode('utf-8')))
+    except (URLError, ValueError):
+        if os.path.exists(delta_dir):
+            shutil.rmtree(delta_dir)
+        return
+
+    if not os.path.exists(delta_dir):
+        os.makedirs(delta_dir)
+    for name in os.listdir(delta_dir):
+        if name not in deltas and not name == 'head.json':
+            os.unlink(os.path.join(delta_dir, name))
+    for name, delta in deltas.items():
+        write_atomic(os.path.join(delta_dir, name), json.dumps(delta))
+    write_atomic(os.path.join(delta_dir, 'head.json'), json.dumps(head, indent=4))
@@ -0,0 +1,158 @@
+import json
+import threading
+
+from functools import wraps
+from time import perf_counter, time
+
+# Nested timed spans. Disabled by default: span() then hands out a shared
+# no-op object, so instrumented code pays a single flag check.
+
+_enabled = False
+_sink = None
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class _Node(object):
+    __slots__ = ('name', 'count', 'total', 'children', 'counters')
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.children = {}
+        self.counters = {}  # sums of numeric span attributes
+
+    def child(self, name):
+        node = self.children.get(name)
+        if node is None:
+            with _lock:
+                node = self.children.setdefault(name, _Node(name))
+        return node
+
+
+_root = _Node(None)
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = [_root]
+    return stack
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ('name', 'attrs', '_node', '_start', '_wall')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = _stack()
+        self._node = stack[-1].child(self.name)
+        stack.append(self._node)
+        self._wall = time()
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = perf_counter() - self._start
+        stack = _stack()
+        stack.pop()
+        with _lock:
+            self._node.count += 1
+            self._node.total += elapsed
+            for k, v in self.attrs.items():
+                if isinstance(v, (int, float)) and not isinstance(v, bool):
+                    self._node.counters[k] = self._node.counters.get(k, 0) + v
+            if _sink:
+                rec = {
+                    'span': '/'.join(n.name for n in stack[1:] + [self._node]),
+                    'start': self._wall,
+                    'duration': elapsed,
+                    'thread': threading.current_thread().name
+                }
+                if exc_type:
+                    rec['error'] = exc_type.__name__
+                if self.attrs:
+                    rec['attrs'] = self.attrs
+                _sink.write(json.dumps(rec, default=str) + '\n')
+                _sink.flush()
+        return False
+
+
+# Usage: with trace.span('extract', files=n) as s: ...; s.set(bytes=total)
+def span(name, **attrs):
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, attrs)
+
+
+# Decorator form of span()
+def traced(name):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Span(name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# sink: optional text file object receiving one JSON record per finished span
+def enable(sink=None):
+    global _enabled, _sink
+    _sink = sink
+    _enabled = True
+
+
+def disable():
+    global _enabled, _sink
+    _enabled = False
+    _sink = None
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _root.children.clear()
+
+
+# Returns aggregated span tree as printable text
+def summary():
+    lines = []
+
+    def walk(node, depth):
+        for child in sorted(node.children.values(), key=lambda n: -n.total):
+            line = '%-48s %6dx %10.4fs' % ('  ' * depth + child.name, child.count, child.total)
+            if child.counters:
+                line += '  ' + ' '.join(k + '=' + str(v) for k, v in sorted(child.counters.items()))
+            lines.append(line)
+            walk(child, depth + 1)
+
+    with _lock:
+        walk(_root, 0)
+    return '\n'.join(lines)
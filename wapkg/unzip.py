@@ -0,0 +1,124 @@
+import os
+import struct
+
+from zipfile import ZIP_STORED
+
+from .clone import break_link
+
+# Stored (uncompressed) members are copied straight from the archive's file
+# offset by the kernel, skipping Python-level buffers. CRC of such members is
+# not checked, so this is done only for archives verified with sha1 as a whole.
+ZERO_COPY = os.sep == '/' and (hasattr(os, 'copy_file_range') or hasattr(os, 'sendfile'))
+
+# Local file header: signature, versions, flags, method, time, date, crc, sizes, name and extra lengths
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+
+
+class ExtractStats(object):
+    def __init__(self):
+        self.files = 0
+        self.zero_copy_files = 0
+        self.zero_copy_bytes = 0
+        self.other_bytes = 0
+
+    def as_dict(self):
+        return {
+            'files': self.files,
+            'zero_copy_files': self.zero_copy_files,
+            'zero_copy_bytes': self.zero_copy_bytes,
+            'other_bytes': self.other_bytes
+        }
+
+
+# Same target path ZipFile.extract() would use (POSIX only)
+def _target_path(name, target):
+    parts = [x for x in name.split('/') if x not in ('', os.curdir, os.pardir)]
+    return os.path.normpath(os.path.join(target, *parts))
+
+
+def _data_offset(fd, info):
+    header = os.pread(fd, LOCAL_HEADER.size, info.header_offset)
+    if len(header) < LOCAL_HEADER.size:
+        return None
+    fh = LOCAL_HEADER.unpack(header)
+    if not fh[0] == b'PK\x03\x04':
+        return None
+    return info.header_offset + LOCAL_HEADER.size + fh[10] + fh[11]
+
+
+def _copy_range(src_fd, dst_fd, offset, count):
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while count > 0:
+                n = os.copy_file_range(src_fd, dst_fd, count, offset)
+                if not n:
+                    break
+                offset += n
+                count -= n
+            return count == 0
+        except OSError:
+            if os.lseek(dst_fd, 0, os.SEEK_CUR):
+                return False  # partially written, let the caller start over
+    while count > 0:
+        n = os.sendfile(dst_fd, src_fd, offset, count)
+        if not n:
+            break
+        offset += n
+        count -= n
+    return count == 0
+
+
+def _zero_copy(src_fd, info, path):
+    offset = _data_offset(src_fd, info)
+    if offset is None:
+        return False
+    d = os.path.dirname(path)
+    if d:
+        os.makedirs(d, exist_ok=True)  # other threads may be extracting into the same directory
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        ok = _copy_range(src_fd, fd, offset, info.file_size)
+    except OSError:
+        ok = False
+    finally:
+        os.close(fd)
+    return ok
+
+
+# Extracts members of an open ZipFile into target, like ZipFile.extract() for
+# each name does. Hardlinked targets are detached first (see clone.break_link).
+# archive: path of the zip file.
+# verified: archive's sha1 was checked, enables zero-copy extraction of stored members.
+# Returns ExtractStats.
+def extract_members(zf, names, target, archive=None, verified=False):
+    stats = ExtractStats()
+    src_fd = None
+    if verified and ZERO_COPY and isinstance(archive, str):
+        src_fd = os.open(archive, os.O_RDONLY)
+
+    # Archive order, so that members of a streamed archive come in one pass
+    infos = sorted((zf.getinfo(n) for n in names), key=lambda x: x.header_offset)
+    try:
+        for info in infos:
+            n = info.filename
+            stats.files += 1
+            if info.is_dir():
+                zf.extract(info, target)
+                continue
+
+            path = _target_path(n, target)
+            break_link(path)
+            if src_fd is not None and info.compress_type == ZIP_STORED and not info.flag_bits & 0x1 \
+                    and info.compress_size == info.file_size and _zero_copy(src_fd, info, path):
+                stats.zero_copy_files += 1
+                stats.zero_copy_bytes += info.file_size
+                continue
+
+            zf.extract(info, target)
+            stats.other_bytes += info.file_size
+    finally:
+        if src_fd is not None:
+            os.close(src_fd)
+
+    return stats
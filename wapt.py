@@ -3,9 +3,13 @@
 # Worms Armageddon Packaging Tool (wapt)
 
 import os
+import shlex
 
-from sys import argv
+from sys import argv, stderr, stdin, exit
 from wapkg import remote
+from wapkg import search
+from wapkg import sync
+from wapkg import trace
 from wapkg.repo import Repository
 from wapkg.version import get_version
 
@@ -16,20 +20,42 @@ Manage multiple W:A versions (a.k.a. distributions) and easily add packages to t
 - usage:
 
 """ + argv[0] + """ install <distro> [packages|files ...] - add package(s) to distro
+""" + argv[0] + """ install --all-dists|--dists=<distro,...> [packages|files ...] - add package(s) \
+to several distros at once, downloading each archive only once
 """ + argv[0] + """ remove <distro> [packages ...] - remove package(s) from distro
 """ + argv[0] + """ dist-install <distro|file> [suggested_name] - install new distro
-""" + argv[0] + """ dist-exterminate <distro> - uninstall distro
+""" + argv[0] + """ dist-exterminate <distro> [--yes] - uninstall distro
+""" + argv[0] + """ dist-archive <distro> - pack distro into a compressed archive inside the repository \
+to free disk space; files shared with other distros (see dist-clone) stay shared
+""" + argv[0] + """ dist-restore <distro> - unpack archived distro (warun does this on launch as well)
+""" + argv[0] + """ dist-clone <distro> <new_name> [--hardlinks] - make a copy of distro, sharing unchanged files \
+with it where the filesystem supports reflinks (copying otherwise); --hardlinks shares files on any filesystem \
+(User directory excepted), but a file rewritten in place by the game or another tool then changes in both distros
 
 """ + argv[0] + """ packages <distro> - list installed packages
+""" + argv[0] + """ owns <distro> <path|prefix> - show which packages own a file, or files under a path
 """ + argv[0] + """ packages-available <distro> - list packages available for download
-""" + argv[0] + """ dists - list installed distributions
+""" + argv[0] + """ dists - list installed (and archived) distributions
 """ + argv[0] + """ dists-available - list distros available for download
+""" + argv[0] + """ search <query> [--offline] - find packages by name, group or description; \
+--offline searches what was fetched last time without contacting sources
+
+""" + argv[0] + """ mirror <source> <dir> [--jobs=N] - copy a source with all its archives into a local directory, \
+which can then be used as a source itself (by path or file:// URL); re-running fetches only what changed
 
 """ + argv[0] + """ init - create distro repository, if it isn't done yet (optional, only required in case \
 if you need to perform some pre-configuration)
 
+""" + argv[0] + """ batch <file|-> - run commands listed in a file (or stdin), one per line, in a single process; \
+failed commands are reported and skipped, exit status is 1 if any failed
+""" + argv[0] + """ shell - interactive mode, same commands without the '""" + argv[0] + """' prefix
+
 """ + argv[0] + """ help - show this message and exit
 """ + argv[0] + """ version - show toolkit version and exit
+
+- options:
+
+--profile[=file] - print per-phase timing summary when done, or append timed spans to file as JSON lines
 """
 
 
@@ -37,9 +63,112 @@ def print_help():
     print(help_msg)
 
 
-def main():
+# Consumes --profile[=file] from the command line, returns True if profiling was requested
+def setup_profiling():
+    opts = [a for a in argv[1:] if a == '--profile' or a.startswith('--profile=')]
+    if not opts:
+        return False
+
+    for a in opts:
+        argv.remove(a)
+
+    sink = None
+    if '=' in opts[-1]:
+        sink = open(opts[-1].split('=', 1)[1], 'a')
+    trace.enable(sink)
+    return True
+
+
+# Keeps repository, sources, fetched indexes and distributions
+# warm between commands run in the same process
+class Session(object):
+    def __init__(self, interactive=True):
+        self.interactive = interactive
+        self._repo = None
+        self._indexes = None
+        self._dists = {}
+
+    def get_repo(self):
+        if not self._repo:
+            self._repo = Repository()
+        return self._repo
+
+    @property
+    def indexes(self):
+        if not self._indexes:
+            self._indexes = self.get_repo().get_index_cache()
+        return self._indexes
+
+    def get_distribution(self, name):
+        if name not in self._dists:
+            self._dists[name] = self.get_repo().get_distribution(name)
+        return self._dists[name]
+
+    def forget_distribution(self, name):
+        self._dists.pop(name, None)
+
+    # Drops everything fetched from sources so far
+    def refresh(self):
+        self._indexes = None
+        self._repo = None
+        self._dists.clear()
+
+    def confirm(self):
+        if not self.interactive:
+            print('(confirmation is not possible in batch mode, pass --yes)')
+            return False
+        return input().lower() == 'y'
+
+
+# Returns number of commands that failed with an error
+def run_batch(lines, session, prompt=None):
+    failed = 0
+    while True:
+        if prompt:
+            try:
+                line = input(prompt)
+            except EOFError:
+                print()
+                break
+        else:
+            line = next(lines, None)
+            if line is None:
+                break
+
+        try:
+            args = shlex.split(line, comments=True)
+        except ValueError as e:
+            print('FAILED: ' + str(e))
+            failed += 1
+            continue
+        if not args:
+            continue
+
+        if args[0] in ('exit', 'quit'):
+            break
+        elif args[0] == 'refresh':
+            session.refresh()
+        elif args[0] in ('batch', 'shell'):
+            print('FAILED: nested ' + args[0] + ' is not supported')
+            failed += 1
+        else:
+            try:
+                with trace.span(args[0]):
+                    run_command(args, session)
+            except (OSError, RuntimeError) as e:
+                print('FAILED: ' + str(e))
+                failed += 1
+            except Exception as e:
+                # Broken archives or metadata, bad arguments, database errors: the rest still runs
+                print('FAILED: ' + type(e).__name__ + ': ' + str(e))
+                failed += 1
+
+    return failed
+
+
+def run_command(args, session):
     try:
-        cmd = argv[1]
+        cmd = args[0]
         if cmd == '-h' or cmd == '--help' or cmd == 'help':
             print_help()
             return
@@ -49,87 +178,185 @@ def main():
             return
 
         elif cmd == 'init':
-            Repository()
+            session.get_repo()
+
+        elif cmd == 'mirror':
+            jobs = 8
+            for a in args[3:]:
+                if a.startswith('--jobs='):
+                    jobs = int(a.split('=', 1)[1])
+
+            print("Mirroring '" + args[1] + "' into '" + args[2] + "'...")
+            res = sync.mirror_source(args[1], args[2], jobs, print)
+            if not res:
+                print('FAILED: Unable to fetch source index')
+                return
+            for path, msg in res.errors:
+                print('FAILED: ' + path + ': ' + msg)
+            if not res.index_updated:
+                print('Index not updated: ' + str(len(res.errors)) + ' archive(s) failed, ' +
+                      'the mirror keeps its previous state until a complete run.')
+            print(str(res.fetched) + ' archives fetched (' + str(int(res.bytes / 1024)) + ' KB), ' +
+                  str(res.unchanged) + ' unchanged, ' + str(res.removed) + ' removed.')
+
+        elif cmd == 'batch':
+            if args[1] == '-':
+                failed = run_batch(iter(stdin.readline, ''), Session(False))
+            else:
+                with open(args[1], 'r') as f:
+                    failed = run_batch(iter(f), Session(False))
+            if failed:
+                print(str(failed) + ' command(s) failed', file=stderr)
+                exit(1)
+
+        elif cmd == 'shell':
+            run_batch(None, session, 'wapt> ')
+
+        elif cmd == 'install' and args[1].startswith('--'):
+            repo = session.get_repo()
+            installed = repo.list_distributions()
+            if args[1] == '--all-dists':
+                dists = sorted(installed)
+            elif args[1].startswith('--dists='):
+                dists = [d for d in args[1].split('=', 1)[1].split(',') if d]
+            else:
+                print_help()
+                return
+
+            for d in dists:
+                if d not in installed:
+                    print("Distribution '" + d + "' is not installed.")
+                    return
+
+            print('Installing ' + ', '.join(args[2:]) + ' into ' + str(len(dists)) + ' distro(s)...')
+            results = repo.install_packages_into(dists, args[2:], repo.get_sources(), session.indexes)
+            for d in dists:
+                session.forget_distribution(d)
+                for pkg, ok, msg in results[d]:
+                    if ok:
+                        print(d + ': ' + pkg + ' - OK')
+                    else:
+                        print(d + ': ' + pkg + ' - FAILED: ' + msg)
 
         elif cmd == 'install':
-            repo = Repository()
-            if argv[2] not in repo.list_distributions():
-                print("Distribution '" + argv[2] + "' is not installed.")
+            repo = session.get_repo()
+            if args[1] not in repo.list_distributions():
+                print("Distribution '" + args[1] + "' is not installed.")
                 return
 
-            dist = repo.get_distribution(argv[2])
-            for pkg in argv[3:]:
+            dist = session.get_distribution(args[1])
+            for pkg in args[2:]:
                 ok, msg = False, ''
+                conflicts = []
                 if os.path.exists(pkg) and os.path.isfile(pkg):
                     print("Installing '" + pkg + "'...")
-                    ok, msg = dist.install_package_from_file(pkg)
+                    ok, msg = dist.install_package_from_file(pkg, conflicts)
                 else:
                     print("Downloading & installing '" + pkg + "'...")
-                    ok, msg = dist.install_package_by_name(pkg, repo.get_sources())
+                    ok, msg = dist.install_package_by_name(pkg, repo.get_sources(), index_cache=session.indexes,
+                                                           conflicts=conflicts)
                 if not ok:
                     print('FAILED: ' + msg)
+                if conflicts:
+                    print('Overwritten files owned by other packages:')
+                    for path, owner in conflicts:
+                        print('  ' + path + ' (' + owner + ')')
 
         elif cmd == 'dist-install':
             ok, msg = False, ''
             suggested_name = None
-            if len(argv) > 3:
-                suggested_name = argv[3]
+            if len(args) > 2:
+                suggested_name = args[2]
             pr = "'..."
             if suggested_name:
                 pr = "' as '" + suggested_name + "'..."
 
-            repo = Repository()
-            if os.path.exists(argv[2]) and os.path.isfile(argv[2]):
-                print("Installing distibution '" + argv[2] + pr)
-                ok, msg, dn = repo.install_dist_from_file(argv[2], suggested_name)
+            repo = session.get_repo()
+            if os.path.exists(args[1]) and os.path.isfile(args[1]):
+                print("Installing distibution '" + args[1] + pr)
+                ok, msg, dn = repo.install_dist_from_file(args[1], suggested_name)
             else:
-                print("Downloading & installing '" + argv[2] + pr)
-                ok, msg, dn = repo.install_dist_by_name(argv[2], repo.get_sources(), suggested_name)
+                print("Downloading & installing '" + args[1] + pr)
+                ok, msg, dn = repo.install_dist_by_name(args[1], repo.get_sources(), suggested_name,
+                                                      index_cache=session.indexes)
             if not ok:
                 print('FAILED: ' + msg)
 
         elif cmd == 'remove':
-            repo = Repository()
-            if argv[2] not in repo.list_distributions():
-                print("Distribution '" + argv[2] + "' is not installed.")
+            repo = session.get_repo()
+            if args[1] not in repo.list_distributions():
+                print("Distribution '" + args[1] + "' is not installed.")
                 return
 
-            for pkg in argv[3:]:
+            for pkg in args[2:]:
                 print("Removing '" + pkg + "'...")
-                ok, msg = repo.get_distribution(argv[2]).remove_package(pkg)
+                ok, msg = session.get_distribution(args[1]).remove_package(pkg)
                 if not ok:
                     print('FAILED: ' + msg)
 
+        elif cmd == 'dist-archive':
+            repo = session.get_repo()
+            print("Archiving '" + args[1] + "'...")
+            ok, msg = repo.archive_distribution(args[1])
+            session.forget_distribution(args[1])
+            if ok:
+                print(msg)
+            else:
+                print('FAILED: ' + msg)
+
+        elif cmd == 'dist-restore':
+            repo = session.get_repo()
+            print("Restoring '" + args[1] + "'...")
+            ok, msg = repo.restore_distribution(args[1])
+            if ok:
+                print(msg)
+            else:
+                print('FAILED: ' + msg)
+
+        elif cmd == 'dist-clone':
+            repo = session.get_repo()
+            print("Cloning '" + args[1] + "' as '" + args[2] + "'...")
+            ok, msg = repo.clone_distribution(args[1], args[2], '--hardlinks' in args[3:])
+            if ok:
+                print(msg)
+            else:
+                print('FAILED: ' + msg)
+
         elif cmd == 'dist-exterminate':
-            repo = Repository()
-            if argv[2] not in repo.list_distributions():
-                print("Distribution '" + argv[2] + "' is not installed.")
+            repo = session.get_repo()
+            if args[1] not in repo.list_distributions():
+                print("Distribution '" + args[1] + "' is not installed.")
                 return
 
-            print("Warning! Distribution '" + argv[2] + "' is about to be completely erased, " +
-                  'including all unmanaged user data. Are you sure want to continue? [y/N]')
-            if not input().lower() == 'y':
-                print('Aborted.')
-                return
-            repo.get_distribution(argv[2]).exterminate()
+            if '--yes' not in args[2:]:
+                print("Warning! Distribution '" + args[1] + "' is about to be completely erased, " +
+                      'including all unmanaged user data. Are you sure want to continue? [y/N]')
+                if not session.confirm():
+                    print('Aborted.')
+                    return
+            session.get_distribution(args[1]).exterminate()
+            session.forget_distribution(args[1])
             print('Okay.')
 
         elif cmd == 'dists':
+            repo = session.get_repo()
             dists = []
-            for d in Repository().list_distributions():
+            for d in repo.list_distributions():
                 dists.append(d)
+            for d in repo.list_archived_distributions():
+                dists.append(d + ' (archived)')
             dists.sort()
             for d in dists:
                 print(d)
 
         elif cmd == 'packages':
-            repo = Repository()
-            if argv[2] not in repo.list_distributions():
-                print("Distribution '" + argv[2] + "' is not installed.")
+            repo = session.get_repo()
+            if args[1] not in repo.list_distributions():
+                print("Distribution '" + args[1] + "' is not installed.")
                 return
 
             packages = []
-            dist = repo.get_distribution(argv[2])
+            dist = session.get_distribution(args[1])
             for pkg in dist.list_packages():
                 packages.append(pkg + ', revision ' + str(dist.get_package_revision(pkg)))
 
@@ -137,11 +364,48 @@ def main():
             for pkg in packages:
                 print(pkg)
 
+        elif cmd == 'owns':
+            repo = session.get_repo()
+            if args[1] not in repo.list_distributions():
+                print("Distribution '" + args[1] + "' is not installed.")
+                return
+
+            owners = session.get_distribution(args[1]).find_owners(args[2])
+            if not owners:
+                print("No package owns '" + args[2] + "'.")
+            for path, pkg in owners:
+                print(path + ': ' + pkg)
+
+        elif cmd == 'search':
+            repo = session.get_repo()
+            words = [a for a in args[1:] if not a == '--offline']
+            if not words:
+                print_help()
+                return
+
+            search_indexes = []
+            for src in repo.get_sources():
+                index = None
+                if '--offline' not in args:
+                    index = session.indexes.fetch(src)
+                search_indexes.append((src, search.get_search_index(repo.index_cache_dir, src, index)))
+
+            results = search.search(' '.join(words), search_indexes)
+            if not results:
+                print('Nothing found.')
+            for name, group, description, src in results:
+                line = name
+                if group:
+                    line = '[' + group + '] ' + line
+                if description:
+                    line += ' - ' + ' '.join(description.split())
+                print(line)
+
         elif cmd == 'dists-available':
-            sources = Repository().get_sources()
+            sources = session.get_repo().get_sources()
             dists = []
             for src in sources:
-                index = remote.fetch_index(src)
+                index = session.indexes.fetch(src)
                 if not index:
                     continue
                 for d in index['distributions']:
@@ -153,18 +417,18 @@ def main():
                 print(x)
 
         elif cmd == 'packages-available':
-            repo = Repository()
-            if argv[2] not in repo.list_distributions():
-                print("Distribution '" + argv[2] + "' is not installed.")
+            repo = session.get_repo()
+            if args[1] not in repo.list_distributions():
+                print("Distribution '" + args[1] + "' is not installed.")
                 return
 
-            dist = repo.get_distribution(argv[2])
+            dist = session.get_distribution(args[1])
             sources = repo.get_sources()
             packages = {}
             pkgs_bundle = []
 
             for src in sources:
-                index = remote.fetch_index(src)
+                index = session.indexes.fetch(src)
                 if not index:
                     continue
                 pkgs = index['packages']
@@ -207,5 +471,16 @@ def main():
     except IndexError:
         print_help()
 
+
+def main():
+    run_command(argv[1:], Session())
+
+
 if __name__ == '__main__':
-    main()
+    if setup_profiling():
+        with trace.span(' '.join(argv[1:2]) or 'wapt'):
+            main()
+        if trace.is_enabled():
+            print(trace.summary(), file=stderr)
+    else:
+        main()
@@ -19,8 +19,14 @@ if __name__ == '__main__':
 
     repo = Repository()
     if argv[1] not in repo.list_distributions():
-        print('No such distro: ' + argv[1])
-        exit(1)
+        if argv[1] not in repo.list_archived_distributions():
+            print('No such distro: ' + argv[1])
+            exit(1)
+        print("Restoring archived distro '" + argv[1] + "'...")
+        ok, msg = repo.restore_distribution(argv[1])
+        if not ok:
+            print('Unable to restore: ' + msg)
+            exit(1)
 
     dist = repo.get_distribution(argv[1])
     null = open(os.devnull, 'w')
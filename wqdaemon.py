@@ -7,6 +7,8 @@ import os
 
 from sys import argv, stdout, exc_info
 from wapkg import remote
+from wapkg import search
+from wapkg import trace
 from socket import *
 from select import select
 from threading import Thread
@@ -15,7 +17,24 @@ from wapkg.download import DownloadAction
 
 help_message = '''
 WapkgQuack service daemon
-usage: ''' + argv[0] + ' [port] [listen_addr]'
+usage: ''' + argv[0] + ''' [port] [listen_addr]
+
+Set WAPKG_TRACE=1 to print per-phase timing summary on exit,
+or WAPKG_TRACE=<file> to append timed spans to file as JSON lines.'''
+
+
+# Returns resident set size of the process in KB, None if unknown
+def resident_memory():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024)
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # peak, KB on Linux
+    except ImportError:
+        return None
 
 
 class WQPacketHandler(object):
@@ -23,7 +42,9 @@ class WQPacketHandler(object):
         self._addrs = []  # recipients
         self._socket = udp_socket
         self._repo = Repository()
-        self._index_cache = []
+        # Replaced as a whole on refresh, so handler threads always see a complete set
+        self._index_cache = ()  # remote.CompactIndex
+        self._search_indexes = ()  # (source, search.SearchIndex)
 
     def handle(self, packet):
         def send(msg):
@@ -49,6 +70,12 @@ class WQPacketHandler(object):
                 msg += d + '\n'
             send(msg)
 
+        def send_dists_archived():
+            msg = 'quack!dists-archived\n'
+            for d in self._repo.list_archived_distributions():
+                msg += d + '\n'  # restored by warun on launch
+            send(msg)
+
         def send_packages_available(distro):
             if distro not in self._repo.list_distributions():
                 return
@@ -57,7 +84,7 @@ class WQPacketHandler(object):
             pkgs_bundle = []
             dist_obj = self._repo.get_distribution(distro)
             for index in self._index_cache:
-                pkgs = index['packages']
+                pkgs = index.packages
                 pkgs_bundle.append(pkgs)
                 for pkg in pkgs:
                     rev = -1
@@ -112,12 +139,33 @@ class WQPacketHandler(object):
 
             send('quack!sources-changed' + sources + '\n')
 
+        def send_search_results(query):
+            msg = 'quack!search-results\nquery/' + query + '\n'
+            for name, group, description, src in search.search(query, self._search_indexes):
+                msg += name + ':' + (group or '') + ':' + ' '.join((description or '').split()) + '\n'
+            send(msg)
+
+        def send_memory():
+            msg = 'quack!memory\n'
+            msg += 'indexes:' + str(len(self._index_cache)) + '\n'
+            msg += 'index-bytes:' + str(remote.footprint(self._index_cache)) + '\n'
+            msg += 'search-bytes:' + str(remote.footprint([si for src, si in self._search_indexes])) + '\n'
+            rss = resident_memory()
+            if rss:
+                msg += 'rss:' + str(rss) + '\n'
+            send(msg)
+
         def update_index():
-            self._index_cache.clear()
+            indexes = []
+            search_indexes = []
             for src in self._repo.get_sources():
-                index = remote.fetch_index(src)
+                # Raw index is dropped right after compacting, only one raw copy exists at a time
+                index = remote.compact_index(self._repo.fetch_index(src))
                 if index:
-                    self._index_cache.append(index)
+                    indexes.append(index)
+                search_indexes.append((src, search.get_search_index(self._repo.index_cache_dir, src, index)))
+            self._index_cache = tuple(indexes)
+            self._search_indexes = tuple(search_indexes)
 
             send('quack!index-changed\n')
 
@@ -125,6 +173,9 @@ class WQPacketHandler(object):
             def update_progress(self, current, total):
                 send('quack!action-update\n' + self.token + '\n' + str(current) + '\n' + str(total) + '\n')
 
+            def update_queue(self, position):
+                send('quack!action-queued\n' + self.token + '\n' + str(position) + '\n')
+
         def handler_thread():
             try:
                 msg, addr = packet
@@ -166,7 +217,8 @@ class WQPacketHandler(object):
                             ok, msg = dist.install_package_from_file(pkg)
                         else:
                             send_text("+ Downloading and installing '" + pkg + "'...")
-                            ok, msg = dist.install_package_by_name(pkg, self._repo.get_sources())
+                            ok, msg = dist.install_package_by_name(pkg, self._repo.get_sources(),
+                                                                   index_cache=self._repo.get_index_cache())
                         if ok:
                             packages_installed += 1
                             recent_package = pkg
@@ -181,6 +233,27 @@ class WQPacketHandler(object):
                             send_text("Installed package '" + recent_package + " into distro '" + wqargs[1] + "'")
                         send_packages_changed(wqargs[1])
 
+                elif req == 'install-many':
+                    # install-many;<distro,distro,...|*>;<package>;...
+                    installed = self._repo.list_distributions()
+                    if wqargs[1] == '*':
+                        dists = installed
+                    else:
+                        dists = [d for d in wqargs[1].split(',') if d in installed]
+
+                    send_text('+ Installing ' + ', '.join(wqargs[2:]) + ' into ' + str(len(dists)) + ' distro(s)...')
+                    results = self._repo.install_packages_into(dists, wqargs[2:], self._repo.get_sources())
+                    for d in dists:
+                        packages_installed = 0
+                        for pkg, ok, msg in results[d]:
+                            if ok:
+                                packages_installed += 1
+                            else:
+                                send_text('! Package installation error (' + pkg + ', ' + d + '): ' + msg)
+                        if packages_installed:
+                            send_packages_changed(d)
+                    send_text('Installed packages into ' + str(len(dists)) + ' distro(s)')
+
                 elif req == 'remove':
                     packages_removed = 0
                     recent_package = None
@@ -246,6 +319,15 @@ class WQPacketHandler(object):
                 elif req == 'dists-available':
                     send_dists_available()
 
+                elif req == 'dists-archived':
+                    send_dists_archived()
+
+                elif req == 'search':
+                    send_search_results(' '.join(wqargs[1:]))
+
+                elif req == 'memory':
+                    send_memory()
+
                 elif req == 'wd':
                     send('quack!wd\n' + self._repo.wd + '\n')
 
@@ -281,6 +363,13 @@ def main():
     except IndexError:
         pass
 
+    trace_opt = os.getenv('WAPKG_TRACE')
+    if trace_opt:
+        sink = None
+        if trace_opt not in ('1', 'summary'):
+            sink = open(trace_opt, 'a')
+        trace.enable(sink)
+
     srv_socket = socket(AF_INET, SOCK_DGRAM)
     handler = WQPacketHandler(srv_socket)
 
@@ -298,6 +387,8 @@ def main():
         pass
     finally:
         srv_socket.close()
+        if trace.is_enabled():
+            print(trace.summary())
 
 if __name__ == '__main__':
     main()
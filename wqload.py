@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+
+# wq load generator and soak test
+# Starts wqdaemon against a temporary repository and a synthetic local source
+# (see wabench.py), drives it with many simulated clients sending a weighted
+# mix of requests and reports throughput, latency percentiles, lost and
+# oversized replies, and how daemon's threads and memory grow over the run.
+
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from time import perf_counter, sleep
+from threading import Thread, Lock
+from socket import socket, AF_INET, SOCK_DGRAM, timeout as SocketTimeout
+
+from wabench import generate_source, SourceServer, make_repository
+
+DAEMON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wqdaemon.py')
+
+# Requests the mix may contain; install and remove of the test package alternate per client
+REQUESTS = ['subscribe', 'packages', 'packages-available', 'install', 'remove', 'update-index',
+            'dists', 'search', 'memory']
+DEFAULT_MIX = 'packages=40,packages-available=20,install=10,remove=10,update-index=5,subscribe=15'
+
+# Largest reply a single Ethernet frame carries; bigger ones are IP-fragmented
+MTU_PAYLOAD = 1472
+MAX_DATAGRAM = 65507
+
+
+def parse_mix(text):
+    mix = []
+    for item in text.split(','):
+        req, sep, weight = item.partition('=')
+        req = req.strip()
+        if req not in REQUESTS:
+            raise ValueError("Unknown request in mix: '" + req + "'")
+        mix.append((req, float(weight) if sep else 1.0))
+    return mix
+
+
+def _free_port():
+    s = socket(AF_INET, SOCK_DGRAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _percentiles(samples):
+    if not samples:
+        return None
+    s = sorted(samples)
+
+    def p(q):
+        return s[min(len(s) - 1, int(q * len(s)))]
+
+    return {
+        'count': len(s),
+        'min': s[0],
+        'p50': p(0.5),
+        'p90': p(0.9),
+        'p99': p(0.99),
+        'p999': p(0.999),
+        'max': s[-1],
+        'mean': sum(s) / len(s)
+    }
+
+
+# Thread count and resident memory of a process, from /proc (None where it is absent)
+def proc_status(pid):
+    res = {'threads': None, 'rss': None}
+    try:
+        with open('/proc/' + str(pid) + '/status', 'r') as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    res['threads'] = int(line.split()[1])
+                elif line.startswith('VmRSS:'):
+                    res['rss'] = int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return res
+
+
+class Daemon(object):
+    def __init__(self, cwd, port):
+        self.port = port
+        self._log = open(os.path.join(cwd, 'wqdaemon.log'), 'w+')
+        self._proc = subprocess.Popen([sys.executable, DAEMON, str(port), '127.0.0.1'], cwd=cwd,
+                                      stdout=subprocess.PIPE, stderr=self._log, universal_newlines=True)
+        if self._proc.stdout.readline().strip() != 'ready':
+            self.stop()
+            raise RuntimeError('wqdaemon failed to start, see ' + self._log.name)
+
+    @property
+    def pid(self):
+        return self._proc.pid
+
+    def alive(self):
+        return self._proc.poll() is None
+
+    # Tracebacks printed by handler threads
+    def errors(self):
+        self._log.seek(0)
+        return self._log.read().count('Traceback')
+
+    def stop(self):
+        if self.alive():
+            self._proc.send_signal(2 if os.name == 'posix' else 15)  # daemon exits cleanly on SIGINT
+            try:
+                self._proc.wait(5)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+                self._proc.wait()
+        self._proc.stdout.close()
+
+
+# Sums shared by client threads
+class Totals(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.sent = {}
+        self.latency = {}
+        self.lost = {}
+        self.datagrams = 0
+        self.bytes = 0
+        self.oversized = 0  # over MTU_PAYLOAD
+        self.largest = 0
+        self.send_errors = 0
+
+    def add(self, name, key, value=1):
+        with self.lock:
+            d = getattr(self, name)
+            if name == 'latency':
+                d.setdefault(key, []).append(value)
+            else:
+                d[key] = d.get(key, 0) + value
+
+
+# One subscriber sending requests at a fixed rate, each one waiting for its reply.
+# Replies are broadcast to all subscribers, so the client picks its own by type and distro.
+class Client(object):
+    def __init__(self, daemon_port, distro, package, mix, rate, reply_timeout, totals):
+        self.daemon = ('127.0.0.1', daemon_port)
+        self.distro = distro
+        self.package = package
+        self.reqs = [r for r, w in mix]
+        self.weights = [w for r, w in mix]
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.reply_timeout = reply_timeout
+        self.totals = totals
+        self.installed = False
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self._send('subscribe;127.0.0.1;' + str(self.sock.getsockname()[1]))
+
+    def _send(self, req):
+        try:
+            self.sock.sendto(('wq/0.1;' + req).encode('utf-8'), self.daemon)
+            return True
+        except OSError:
+            with self.totals.lock:
+                self.totals.send_errors += 1
+            return False
+
+    # Request and the reply prefix that completes it (None for requests without a reply)
+    def _request(self, req):
+        if req in ('install', 'remove'):
+            req = 'remove' if self.installed else 'install'
+            self.installed = not self.installed
+            return req, req + ';' + self.distro + ';' + self.package, \
+                'quack!packages-changed\ndistro/' + self.distro + '\n'
+        if req == 'subscribe':
+            return req, req + ';127.0.0.1;' + str(self.sock.getsockname()[1]), None
+        if req in ('packages', 'packages-available'):
+            reply = 'packages-changed' if req == 'packages' else req
+            return req, req + ';' + self.distro, 'quack!' + reply + '\ndistro/' + self.distro + '\n'
+        if req == 'update-index':
+            return req, req, 'quack!index-changed\n'
+        if req == 'dists':
+            return req, req, 'quack!dists-changed\n'
+        if req == 'search':
+            return req, req + ';' + self.package, 'quack!search-results\nquery/' + self.package + '\n'
+        return req, req, 'quack!' + req + '\n'
+
+    def _receive(self, prefix, deadline):
+        while True:
+            left = deadline - perf_counter()
+            if left <= 0:
+                return False
+            self.sock.settimeout(left)
+            try:
+                data = self.sock.recv(65536)
+            except SocketTimeout:
+                return False
+            with self.totals.lock:
+                self.totals.datagrams += 1
+                self.totals.bytes += len(data)
+            if prefix and data.startswith(prefix):
+                with self.totals.lock:
+                    if len(data) > MTU_PAYLOAD:
+                        self.totals.oversized += 1
+                    self.totals.largest = max(self.totals.largest, len(data))
+                return True
+
+    def _drain(self):
+        self.sock.settimeout(0)
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                with self.totals.lock:
+                    self.totals.datagrams += 1
+                    self.totals.bytes += len(data)
+        except (SocketTimeout, BlockingIOError):
+            pass
+
+    def run(self, until):
+        rnd = random.Random(self.distro)
+        next_at = perf_counter()
+        while perf_counter() < until:
+            req, packet, prefix = self._request(rnd.choices(self.reqs, self.weights)[0])
+            self._drain()  # other clients' replies are not ours
+            start = perf_counter()
+            self.totals.add('sent', req)
+            if not self._send(packet):
+                continue
+            if prefix:
+                if self._receive(prefix.encode('utf-8'), start + self.reply_timeout):
+                    self.totals.add('latency', req, perf_counter() - start)
+                else:
+                    self.totals.add('lost', req)
+                    if req in ('install', 'remove'):
+                        self.installed = None  # unknown, next one tells
+            next_at = max(next_at + self.interval, perf_counter())
+            sleep(max(0, next_at - perf_counter()))
+
+        self._send('unsubscribe;127.0.0.1;' + str(self.sock.getsockname()[1]))
+        self.sock.close()
+
+
+# Samples daemon's threads and memory every few seconds
+class Monitor(object):
+    def __init__(self, daemon, interval):
+        self.daemon = daemon
+        self.interval = interval
+        self.samples = []
+        self._start = perf_counter()
+        self._stopped = False
+        self._sock = socket(AF_INET, SOCK_DGRAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self._thread = Thread(target=self._run, daemon=True)
+
+    # Index footprint as reported by the daemon itself ('memory' request)
+    def _query_memory(self):
+        addr = ('127.0.0.1', self.daemon.port)
+        port = str(self._sock.getsockname()[1])
+        self._sock.sendto(('wq/0.1;subscribe;127.0.0.1;' + port).encode('utf-8'), addr)
+        self._sock.sendto(b'wq/0.1;memory', addr)
+        deadline = perf_counter() + 2
+        res = {}
+        try:
+            while perf_counter() < deadline and not res:
+                self._sock.settimeout(max(0.01, deadline - perf_counter()))
+                data = self._sock.recv(65536).decode('utf-8')
+                if data.startswith('quack!memory\n'):
+                    for line in data.split('\n')[1:]:
+                        key, sep, value = line.partition(':')
+                        if sep:
+                            res[key] = int(value)
+        except SocketTimeout:
+            pass
+        self._sock.sendto(('wq/0.1;unsubscribe;127.0.0.1;' + port).encode('utf-8'), addr)
+        return res
+
+    def sample(self):
+        st = proc_status(self.daemon.pid)
+        mem = self._query_memory()
+        self.samples.append({
+            'time': round(perf_counter() - self._start, 3),
+            'threads': st['threads'],
+            'rss': st['rss'] or mem.get('rss'),
+            'index_bytes': mem.get('index-bytes'),
+            'search_bytes': mem.get('search-bytes')
+        })
+
+    def _run(self):
+        while not self._stopped:
+            sleep(self.interval)
+            if not self._stopped and self.daemon.alive():
+                self.sample()
+
+    def start(self):
+        self.sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._thread.join()
+        if self.daemon.alive():
+            self.sample()
+        self._sock.close()
+
+    # Difference between the first and the last sample, peak value
+    def growth(self, key):
+        values = [s[key] for s in self.samples if s[key] is not None]
+        if not values:
+            return None
+        return {'start': values[0], 'end': values[-1], 'peak': max(values), 'growth': values[-1] - values[0]}
+
+
+def run(opts):
+    mix = parse_mix(opts.mix)
+    root = tempfile.mkdtemp(prefix='wqload-')
+    cwd = os.getcwd()
+    try:
+        src = os.path.join(root, 'source')
+        info = generate_source(src, opts.packages, opts.archives, chain_depth=8, pkg_files=opts.pkg_files,
+                               pkg_file_size=opts.pkg_file_size, dist_files=20, dist_file_size=4096)
+        work = os.path.join(root, 'repo')
+        os.mkdir(work)
+        os.chdir(work)
+
+        with SourceServer(src) as server:
+            repo = make_repository([server.url])
+            ok, msg, dn = repo.install_dist_from_file(os.path.join(src, 'distributions', 'bench.zip'), 'client-0')
+            if not ok:
+                raise RuntimeError(msg)
+            distros = ['client-' + str(i) for i in range(opts.clients)]
+            for d in distros[1:]:
+                repo.clone_distribution(distros[0], d)
+
+            daemon = Daemon(work, opts.port or _free_port())
+            try:
+                # Index is loaded once up front, so packages-available has something to list
+                warmup = Client(daemon.port, distros[0], opts.package, [('update-index', 1)], 0, 30, Totals())
+                warmup._send('update-index')
+                warmup._receive(b'quack!index-changed\n', perf_counter() + 30)
+                warmup.sock.close()
+
+                totals = Totals()
+                clients = [Client(daemon.port, d, opts.package, mix, opts.rate, opts.timeout, totals)
+                           for d in distros]
+                monitor = Monitor(daemon, opts.sample_every)
+                monitor.start()
+
+                start = perf_counter()
+                until = start + opts.duration
+                threads = [Thread(target=c.run, args=(until,)) for c in clients]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                elapsed = perf_counter() - start
+                monitor.stop()
+
+                alive = daemon.alive()
+                errors = daemon.errors()
+            finally:
+                daemon.stop()
+
+        sent = sum(totals.sent.values())
+        answered = sum(len(v) for v in totals.latency.values())
+        lost = sum(totals.lost.values())
+        all_latency = [x for v in totals.latency.values() for x in v]
+        return {
+            'params': dict(vars(opts)),
+            'source': info,
+            'duration': elapsed,
+            'requests': {
+                'sent': sent,
+                'answered': answered,
+                'lost': lost,
+                'send_errors': totals.send_errors,
+                'by_type': {req: {'sent': totals.sent.get(req, 0), 'lost': totals.lost.get(req, 0)}
+                            for req in totals.sent}
+            },
+            'throughput': answered / elapsed if elapsed else 0,
+            'latency': _percentiles(all_latency),
+            'latency_by_type': {req: _percentiles(v) for req, v in totals.latency.items()},
+            'replies': {
+                'datagrams': totals.datagrams,
+                'bytes': totals.bytes,
+                'oversized': totals.oversized,
+                'largest': totals.largest,
+                'mtu_payload': MTU_PAYLOAD,
+                'max_datagram': MAX_DATAGRAM
+            },
+            'daemon': {
+                'alive': alive,
+                'errors': errors,
+                'threads': monitor.growth('threads'),
+                'rss': monitor.growth('rss'),
+                'index_bytes': monitor.growth('index_bytes')
+            },
+            'samples': monitor.samples
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='wq protocol load generator and soak test')
+    ap.add_argument('--clients', type=int, default=16, help='number of simulated clients, one distro each')
+    ap.add_argument('--duration', type=float, default=60, help='length of the run, seconds')
+    ap.add_argument('--rate', type=float, default=5, help='requests per second per client, 0 for no pause')
+    ap.add_argument('--mix', default=DEFAULT_MIX,
+                    help='weighted requests, e.g. packages=5,install=1 (one of: ' + ', '.join(REQUESTS) + ')')
+    ap.add_argument('--timeout', type=float, default=5, help='seconds a reply is waited for before it counts as lost')
+    ap.add_argument('--package', default='chain-7', help='package installed and removed by clients')
+    ap.add_argument('--packages', type=int, default=500, help='number of packages in the synthetic index')
+    ap.add_argument('--archives', type=int, default=8, help='number of distinct package archives')
+    ap.add_argument('--pkg-files', type=int, default=5, help='files per package archive')
+    ap.add_argument('--pkg-file-size', type=int, default=4096, help='size of each package file, bytes')
+    ap.add_argument('--sample-every', type=float, default=5, help='seconds between thread/memory samples')
+    ap.add_argument('--port', type=int, default=0, help='daemon port, a free one by default')
+    ap.add_argument('--output', help='write JSON results to this file instead of stdout')
+    opts = ap.parse_args()
+
+    output = opts.output
+    del opts.output
+
+    try:
+        parse_mix(opts.mix)
+    except ValueError as e:
+        ap.error(str(e))
+
+    res = run(opts)
+    data = json.dumps(res, sort_keys=True, indent=4)
+    if output:
+        with open(output, 'w') as f:
+            f.write(data)
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()